@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+"""
+form_mappers.py -- micro-benchmark of the precomputed form field
+    mappers (CONFERENCE_FORM_MAPPER & co in conference.py) against the
+    reflective all_fields() loops they replaced
+
+usage: python benchmarks/form_mappers.py [--sdk SDK_PATH] [--rows N]
+
+Needs the App Engine Python SDK, found at --sdk, $APPENGINE_SDK or the
+directory holding dev_appserver.py on $PATH. No datastore is involved;
+the entities are built in memory.
+
+"""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+from datetime import date
+from datetime import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def findSdk():
+    """Return the SDK directory from $APPENGINE_SDK or $PATH, if any."""
+    if os.environ.get('APPENGINE_SDK'):
+        return os.environ['APPENGINE_SDK']
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.path.exists(os.path.join(path, 'dev_appserver.py')):
+            return os.path.realpath(path)
+    return None
+
+
+def setUpSdk(sdk_path):
+    """Put the SDK, its bundled libraries and the app on sys.path."""
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    endpoints_path = os.path.join(sdk_path, 'lib', 'endpoints-1.0')
+    if os.path.isdir(endpoints_path):
+        sys.path.insert(0, endpoints_path)
+    sys.path.insert(0, APP_DIR)
+    # Key.urlsafe() needs an app id
+    os.environ.setdefault('APPLICATION_ID', 'dev~benchmark')
+
+
+# - - - the loops the mappers replaced - - - - - - - - - - - - -
+
+def reflectiveConferenceToForm(conf, displayName):
+    from models import ConferenceForm
+    cf = ConferenceForm()
+    for field in cf.all_fields():
+        if hasattr(conf, field.name):
+            # convert Date to date string; just copy others
+            if field.name.endswith('Date'):
+                setattr(cf, field.name, str(getattr(conf, field.name)))
+            else:
+                setattr(cf, field.name, getattr(conf, field.name))
+        elif field.name == "websafeKey":
+            setattr(cf, field.name, conf.key.urlsafe())
+    if displayName:
+        setattr(cf, 'organizerDisplayName', displayName)
+    cf.check_initialized()
+    return cf
+
+
+def reflectiveSessionToForm(session):
+    from models import SessionForm
+    from models import SessionType
+    sf = SessionForm()
+    for field in sf.all_fields():
+        if hasattr(session, field.name):
+            # convert Date to date string; just copy others
+            if field.name.endswith('Date') or \
+               field.name.endswith('Time') or \
+               field.name == 'duration':
+                setattr(sf, field.name, str(getattr(session, field.name)))
+            elif field.name == 'typeOfSession':
+                value = getattr(session, field.name)
+                if value:
+                    value = str(getattr(session, field.name))
+                else:
+                    value = 'NOT_SPECIFIED'
+                setattr(sf, field.name, getattr(SessionType, value))
+            else:
+                setattr(sf, field.name, getattr(session, field.name))
+        elif field.name == 'websafeKey':
+            setattr(sf, field.name, session.key.urlsafe())
+        elif field.name == 'conferenceWebsafeKey':
+            key = session.key.parent()
+            if key:
+                setattr(sf, field.name, key.urlsafe())
+    sf.check_initialized()
+    return sf
+
+
+def reflectiveSpeakerToForm(speaker):
+    from models import SpeakerForm
+    sf = SpeakerForm()
+    for field in sf.all_fields():
+        if hasattr(speaker, field.name):
+            setattr(sf, field.name, getattr(speaker, field.name))
+        elif field.name == "websafeKey":
+            setattr(sf, field.name, speaker.key.urlsafe())
+    sf.check_initialized()
+    return sf
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def makeEntities(rows):
+    """Return (conferences, sessions, speakers), rows of each."""
+    from google.appengine.ext import ndb
+    from models import Conference
+    from models import Session
+    from models import SessionType
+    from models import Speaker
+
+    session_types = SessionType.names()
+    conferences = []
+    sessions = []
+    speakers = []
+    for i in range(1, rows + 1):
+        conf_key = ndb.Key(Conference, i)
+        conferences.append(Conference(
+            key=conf_key, name='Conference %d' % i, description='About %d' % i,
+            organizerUserId='organizer%d' % (i % 10), topics=['Web', 'Python'],
+            city='London', startDate=date(2026, i % 12 + 1, 1), month=i % 12 + 1,
+            endDate=date(2026, i % 12 + 1, 3), maxAttendees=100, seatsAvailable=50))
+        speaker_key = ndb.Key(Speaker, i)
+        speakers.append(Speaker(key=speaker_key, displayName='Speaker %d' % i,
+                                bio='Speaks about %d' % i))
+        sessions.append(Session(
+            key=ndb.Key(Session, i, parent=conf_key), name='Session %d' % i,
+            highlights=['one', 'two'], duration=time(1, 0),
+            typeOfSession=random.choice(session_types),
+            localDate=date(2026, 5, 1), localTime=time(i % 24, 0),
+            speakerWebsafeKeys=[speaker_key.urlsafe()]))
+    return conferences, sessions, speakers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sdk', default=findSdk(),
+                        help='App Engine Python SDK directory')
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='entities per list response (default 1000)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timing runs, the best is reported (default 5)')
+    args = parser.parse_args()
+    if not args.sdk:
+        parser.error('cannot find the App Engine SDK; pass --sdk')
+    setUpSdk(args.sdk)
+
+    from conference import ConferenceApi
+    api = ConferenceApi()
+    conferences, sessions, speakers = makeEntities(args.rows)
+
+    cases = [
+        ('Conference', conferences,
+         lambda conf: reflectiveConferenceToForm(conf, 'Organizer'),
+         lambda conf: api._copyConferenceToForm(conf, 'Organizer')),
+        ('Session', sessions, reflectiveSessionToForm, api._copySessionToForm),
+        ('Speaker', speakers, reflectiveSpeakerToForm, api._copySpeakerToForm),
+    ]
+
+    print '%-12s %12s %12s %8s' % ('%d rows' % args.rows, 'reflective', 'mapper', 'speedup')
+    for name, entities, reflective, mapper in cases:
+        # both must produce the same forms for the timings to mean anything
+        for entity in entities:
+            assert reflective(entity) == mapper(entity), name
+
+        def timeCopies(copy):
+            return min(timeit.repeat(lambda: [copy(entity) for entity in entities],
+                                     repeat=args.repeat, number=1))
+        reflective_time = timeCopies(reflective)
+        mapper_time = timeCopies(mapper)
+        print '%-12s %10.1fms %10.1fms %7.2fx' % (
+            name, reflective_time * 1000, mapper_time * 1000,
+            reflective_time / mapper_time)
+
+
+if __name__ == '__main__':
+    main()
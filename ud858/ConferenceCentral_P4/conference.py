@@ -13,20 +13,34 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
+import calendar
+import collections
+import itertools
+import logging
+import operator
+import os
+import random
+from datetime import date
 from datetime import datetime
 from datetime import time
+from datetime import timedelta
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.datastore import datastore_index
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from models import ConflictException
 from models import Profile
+from models import ConferenceSchedule
 from models import ProfileMiniForm
 from models import ProfileForm
 from models import StringMessage
@@ -36,10 +50,14 @@ from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import SeatShard
+from models import NearlySoldOut
 from models import TeeShirtSize
 from models import Session
 from models import SessionForm
 from models import SessionForms
+from models import SessionQueryForm
+from models import SessionQueryForms
 from models import SessionType
 from models import WebsafeConferenceKeyMessage
 from models import Speaker
@@ -51,15 +69,56 @@ from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
+from settings import ROOT_SESSIONS
 
+from utils import allocateId
 from utils import getUserId
+from utils import incrCounter
+from utils import getKeywords
+from utils import recordRpcStats
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+MEMCACHE_ANNOUNCEMENTS_CITY_KEY_TPL = "RECENT_ANNOUNCEMENTS:%s"
+ANNOUNCEMENT_TIMEOUT = 10 * 60 # seconds
+NEARLY_SOLD_OUT_SEATS = 5
+SCHEDULE_ID = 1
+SCHEDULE_INVALIDATE_BATCH_SIZE = 100
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
 MEMCACHE_FEATURED_SPEAKER_KEY = "FEATURED_SPEAKER"
+MEMCACHE_FEATURED_SPEAKER_KEY_TPL = "FEATURED_SPEAKER:%s"
+FEATURED_SPEAKER_TIMEOUT = 60 * 60 # seconds
+MEMCACHE_CONFERENCE_KEY_TPL = "CONFERENCE:%s"
+MEMCACHE_CONFERENCE_HITS_KEY = "CONFERENCE_CACHE_HITS"
+MEMCACHE_CONFERENCE_MISSES_KEY = "CONFERENCE_CACHE_MISSES"
+CONFERENCE_CACHE_TIMEOUT = 60 * 60 # seconds
+# while this is in memcache a reader that loaded the conference before
+# our write can't put its (stale) copy back in the cache
+CONFERENCE_CACHE_LOCK = ""
+CONFERENCE_CACHE_LOCK_TIMEOUT = 10 # seconds
+# NOTE: must stay well below the 25 entity groups an XG
+# transaction may touch, see _initSeatShards()
+NUM_SEAT_SHARDS = 10
+# conferences with shards written within this window get their
+# nearly sold out flag checked; keep it above the cron interval
+SEAT_RECONCILE_WINDOW = 10 * 60 # seconds
+MAX_SESSIONS_BATCH_SIZE = 500
+# root sessions are found with an eventually consistent query, so keep
+# the ones just written in memcache for a little while
+MEMCACHE_RECENT_SESSIONS_KEY_TPL = "RECENT_SESSIONS:%s"
+RECENT_SESSIONS_TIMEOUT = 60 # seconds
+RECENT_SESSIONS_CAS_RETRIES = 10
+SESSIONS_PUT_CHUNK_SIZE = 100
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# conference queries with inequalities on several fields: the counts
+# we plan with stop here, and a page stops scanning for matches here
+QUERY_ESTIMATE_LIMIT = 1000
+QUERY_SCAN_BATCH_SIZE = 50
+MAX_QUERY_SCAN = 500
+INDEX_AUDIT_SAMPLE_SIZE = 100
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -84,6 +143,15 @@ OPERATORS = {
             'NE':   '!='
             }
 
+OPERATOR_FUNCS = {
+            '=':    operator.eq,
+            '>':    operator.gt,
+            '>=':   operator.ge,
+            '<':    operator.lt,
+            '<=':   operator.le,
+            '!=':   operator.ne,
+            }
+
 FIELDS =    {
             'CITY': 'city',
             'TOPIC': 'topics',
@@ -91,6 +159,110 @@ FIELDS =    {
             'MAX_ATTENDEES': 'maxAttendees',
             }
 
+SESSION_FIELDS = {
+            'START_TIME': 'localTime',
+            'DATE': 'localDate',
+            'DURATION': 'duration',
+            'TYPE_OF_SESSION': 'typeOfSession',
+            'SPEAKER': 'speakerWebsafeKeys',
+            }
+
+SESSION_FIELD_PARSERS = {
+            'localTime': lambda value: datetime.strptime(value[:5], "%H:%M").time(),
+            'localDate': lambda value: datetime.strptime(value[:10], "%Y-%m-%d").date(),
+            'duration': lambda value: datetime.strptime(value[:5], "%H:%M").time(),
+            'typeOfSession': lambda value: str(SessionType(value.upper())),
+            'speakerWebsafeKeys': str,
+            }
+
+ORDER_FIELDS =  {
+            'NAME': 'name',
+            'CITY': 'city',
+            'START_DATE': 'startDate',
+            'MONTH': 'month',
+            'MAX_ATTENDEES': 'maxAttendees',
+            }
+
+INDEX_YAML = os.path.join(os.path.dirname(__file__), 'index.yaml')
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def _loadConferenceIndexes():
+    """Return the (equality properties, sort orders) of the Conference
+    composite indexes in index.yaml, or None if it can't be read.
+    """
+    try:
+        with open(INDEX_YAML) as f:
+            definitions = datastore_index.ParseIndexDefinitions(f)
+    except Exception as e:
+        # index.yaml may be left out of the upload; the datastore
+        # still rejects queries without an index, just less politely
+        logging.warning('Cannot read %s: %s', INDEX_YAML, e)
+        return None
+
+    indexes = []
+    for index in (definitions and definitions.indexes) or []:
+        if index.kind != 'Conference' or index.ancestor:
+            continue
+        indexes.append([(prop.name, prop.direction or 'asc')
+                        for prop in index.properties])
+    return indexes
+
+CONFERENCE_INDEXES = _loadConferenceIndexes()
+
+def _buildFormMapper(form_class, model_class, converters):
+    """Return (field name, getter) pairs for the fields of form_class
+    that can be filled from a model_class entity. Built once at import,
+    so the _copy*ToForm() methods don't have to reflect per entity.
+    """
+    mapper = []
+    for field in form_class.all_fields():
+        if field.name in converters:
+            mapper.append((field.name, converters[field.name]))
+        elif hasattr(model_class, field.name):
+            mapper.append((field.name, operator.attrgetter(field.name)))
+    return mapper
+
+def _strAttr(name):
+    """Return a getter converting Date/Time properties to strings."""
+    getter = operator.attrgetter(name)
+    return lambda entity: str(getter(entity))
+
+def _websafeKey(entity):
+    return entity.key.urlsafe()
+
+def _conferenceWebsafeKey(session):
+    conf_key = session.conferenceKey or session.key.parent()
+    return conf_key.urlsafe() if conf_key else None
+
+def _sessionType(session):
+    return getattr(SessionType, session.typeOfSession or 'NOT_SPECIFIED')
+
+SPEAKER_FORM_MAPPER = _buildFormMapper(SpeakerForm, Speaker, {
+    'websafeKey': _websafeKey,
+})
+
+SESSION_FORM_MAPPER = _buildFormMapper(SessionForm, Session, {
+    'duration': _strAttr('duration'),
+    'localDate': _strAttr('localDate'),
+    'localTime': _strAttr('localTime'),
+    'typeOfSession': _sessionType,
+    'conferenceWebsafeKey': _conferenceWebsafeKey,
+    'websafeKey': _websafeKey,
+})
+
+CONFERENCE_FORM_MAPPER = _buildFormMapper(ConferenceForm, Conference, {
+    'startDate': _strAttr('startDate'),
+    'endDate': _strAttr('endDate'),
+    'websafeKey': _websafeKey,
+})
+
+PROFILE_FORM_MAPPER = _buildFormMapper(ProfileForm, Profile, {
+    'teeShirtSize': lambda prof: getattr(TeeShirtSize, prof.teeShirtSize),
+    'conferenceKeysToAttend':
+        lambda prof: [key.urlsafe() for key in prof.conferenceKeysToAttend],
+})
+
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
@@ -101,25 +273,39 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+PAGE_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(2),
+    )
+
 WEBSAFE_CONFERENCE_KEY_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
     )
 
 CONFERENCE_SESSIONS_BY_TYPE_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
-    typeOfSession=messages.StringField(2)
+    typeOfSession=messages.StringField(2),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(4),
     )
 
 SPEAKER_SESSIONS_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    websafeSpeakerKey=messages.StringField(1)
+    websafeSpeakerKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
     )
 
 SESSION_TOPIC_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    topic=messages.StringField(1)
+    topic=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
     )
 
 SESSION_POST_REQUEST = endpoints.ResourceContainer(
@@ -127,10 +313,28 @@ SESSION_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+SESSIONS_BATCH_POST_REQUEST = endpoints.ResourceContainer(
+    SessionForms,
+    websafeConferenceKey=messages.StringField(1),
+)
+
+ANNOUNCEMENT_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    city=messages.StringField(1),
+)
+
 WISHLIST_POST_REQUEST = endpoints.ResourceContainer(
     websafeSessionKey=messages.StringField(1, required=True),
 )
 
+def _instrumentedMethod(*args, **kwargs):
+    """endpoints.method that also records the RPC stats of the method
+    (see /admin/rpc_stats).
+    """
+    def decorator(func):
+        return endpoints.method(*args, **kwargs)(recordRpcStats(func))
+    return decorator
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
@@ -140,16 +344,69 @@ WISHLIST_POST_REQUEST = endpoints.ResourceContainer(
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
+    # NOTE: endpoints creates a new service object for every request,
+    # so these cache the current user & Profile for one request only
+    _user = None
+    _userId = None
+    _profile = None
+
+# - - - Current user - - - - - - - - - - - - - - - - - - - - -
+
+    def _getUser(self):
+        """Return the current user, raising if not authorized."""
+        if self._user is None:
+            user = endpoints.get_current_user()
+            if not user:
+                raise endpoints.UnauthorizedException('Authorization required')
+            self._user = user
+        return self._user
+
+
+    def _getUserId(self):
+        """Return the user ID of the current user."""
+        if self._userId is None:
+            self._userId = getUserId(self._getUser())
+        return self._userId
+
+# - - - Paging - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _getPageParams(self, request):
+        """Return the checked (page size, start cursor) of the request."""
+        page_size = request.pageSize or DEFAULT_PAGE_SIZE
+        if not 0 < page_size <= MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "'pageSize' must be between 1 and %d." % MAX_PAGE_SIZE)
+
+        cursor = None
+        if request.pageToken:
+            try:
+                cursor = Cursor(urlsafe=request.pageToken)
+            except datastore_errors.BadValueError:
+                raise endpoints.BadRequestException("Invalid 'pageToken'.")
+        return page_size, cursor
+
+
+    def _fetchPage(self, query, request, **kwargs):
+        """Fetch one page of query results using the pageSize and
+        pageToken of the request. Returns (results, nextPageToken).
+        """
+        page_size, cursor = self._getPageParams(request)
+        results, next_cursor, more = query.fetch_page(
+            page_size, start_cursor=cursor, **kwargs)
+
+        # only hand out a token if there really is another page
+        next_page_token = None
+        if more and next_cursor:
+            next_page_token = next_cursor.urlsafe()
+        return results, next_page_token
+
 # - - - Speaker objects - - - - - - - - - - - - - - - - - - -
 
     def _copySpeakerToForm(self, speaker):
         """Copy relevant fields from Speaker to SpeakerForm."""
         sf = SpeakerForm()
-        for field in sf.all_fields():
-            if hasattr(speaker, field.name):
-                setattr(sf, field.name, getattr(speaker, field.name))
-            elif field.name == "websafeKey":
-                setattr(sf, field.name, speaker.key.urlsafe())
+        for name, getter in SPEAKER_FORM_MAPPER:
+            setattr(sf, name, getter(speaker))
         sf.check_initialized()
         return sf
 
@@ -157,9 +414,7 @@ class ConferenceApi(remote.Service):
     def _createSpeakerObject(self, request):
         """Create or update Speaker object, returning SpeakerForm/request."""
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        user = self._getUser()
 
         if not request.displayName:
             raise endpoints.BadRequestException("Speaker 'displayName' field required")
@@ -172,9 +427,7 @@ class ConferenceApi(remote.Service):
         del data['websafeKey']
 
         # Now create the speaker key.
-        # NOTE: allocate_ids returns a list, so take the first element.
-        speaker_id = Speaker.allocate_ids(size=1)[0]
-        speaker_key = ndb.Key(Speaker, speaker_id)
+        speaker_key = ndb.Key(Speaker, allocateId(Speaker))
         data['key'] = speaker_key
 
         # create Speaker, send email to creator confirming
@@ -187,7 +440,7 @@ class ConferenceApi(remote.Service):
         return request
 
 
-    @endpoints.method(SpeakerForm, SpeakerForm,
+    @_instrumentedMethod(SpeakerForm, SpeakerForm,
                   path='speaker/create',
                   http_method='POST',
                   name='createSpeaker')
@@ -196,29 +449,27 @@ class ConferenceApi(remote.Service):
         # only authenticated users can create speakers
         # TODO: should we track the user who entered the speaker?
         # maybe filter for users who have created at least one conference.
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        user = self._getUser()
         speaker = self._createSpeakerObject(request)
         return speaker
 
 
-    @endpoints.method(message_types.VoidMessage, SpeakerForms,
+    @_instrumentedMethod(PAGE_GET_REQUEST, SpeakerForms,
         path='speaker',
         http_method='POST', name='getSpeakers')
     def getSpeakers(self, request):
-        """Return all the speakers."""
+        """Return a page of speakers."""
 
-        # create ancestor query for all key matches for this conference
-        speakers = Speaker.query()
+        speakers, next_page_token = self._fetchPage(Speaker.query(), request)
 
         # return set of ConferenceForm objects per Conference
         return SpeakerForms(
-            items=[self._copySpeakerToForm(speaker) for speaker in speakers]
+            items=[self._copySpeakerToForm(speaker) for speaker in speakers],
+            nextPageToken=next_page_token
         )
 
 
-    @endpoints.method(SPEAKER_SESSIONS_GET_REQUEST, SessionForms,
+    @_instrumentedMethod(SPEAKER_SESSIONS_GET_REQUEST, SessionForms,
             path='speaker/{websafeSpeakerKey}/session',
             http_method='POST',
             name='getSessionsBySpeaker')
@@ -231,13 +482,15 @@ class ConferenceApi(remote.Service):
             raise endpoints.NotFoundException(
                 'No speaker found with key: %s' % request.websafeSpeakerKey)
 
-        # create ancestor query for all key matches for this conference
-        speaker_id = speaker.key.id()
-        sessions = Session.query().filter(speaker_id == Session.speakerIds)
+        # find all sessions that list this speaker
+        sessions, next_page_token = self._fetchPage(
+            Session.query(Session.speakerWebsafeKeys == speaker.key.urlsafe()),
+            request)
 
         # return set of ConferenceForm objects per Conference
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
+            items=[self._copySessionToForm(session) for session in sessions],
+            nextPageToken=next_page_token
         )
 
 # - - - Session objects - - - - - - - - - - - - - - - - - - -
@@ -245,45 +498,24 @@ class ConferenceApi(remote.Service):
     def _copySessionToForm(self, session):
         """Copy relevant fields from Session to SessionForm."""
         sf = SessionForm()
-        for field in sf.all_fields():
-            if hasattr(session, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date') or \
-                   field.name.endswith('Time') or \
-                   field.name == 'duration':
-                    setattr(sf, field.name, str(getattr(session, field.name)))
-                elif field.name == 'typeOfSession':
-                    value = getattr(session, field.name)
-                    if value:
-                        value = str(getattr(session, field.name))
-                    else:
-                        value = 'NOT_SPECIFIED'
-                    setattr(sf, field.name, getattr(SessionType, value))
-                else:
-                    setattr(sf, field.name, getattr(session, field.name))
-            elif field.name == 'websafeKey':
-                setattr(sf, field.name, session.key.urlsafe())
-            elif field.name == 'conferenceWebsafeKey':
-                key = session.key.parent()
-                if key:
-                    setattr(sf, field.name, key.urlsafe())
+        # convert Date/Time to strings, session type to Enum (see
+        # SESSION_FORM_MAPPER); just copy others
+        for name, getter in SESSION_FORM_MAPPER:
+            setattr(sf, name, getter(session))
         sf.check_initialized()
         return sf
 
 
-    def _createSessionObject(self, request):
-        """Create or update Session object, returning SessionForm/request."""
+    def _getConferenceForSessions(self, websafeConferenceKey):
+        """Return (user, conference) after checking that the current
+        user may create sessions for the conference.
+        """
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-
-        if not request.name:
-            raise endpoints.BadRequestException("Session 'name' field required")
+        user = self._getUser()
+        user_id = self._getUserId()
 
         # get the conference from the websafe key
-        conference = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conference = self._getConference(websafeConferenceKey)
 
         # NOTE: this sould be shielded by the API methods, but we
         # will check here, just to be sure.
@@ -293,18 +525,31 @@ class ConferenceApi(remote.Service):
         if conference.organizerUserId != user_id:
             raise endpoints.BadRequestException("You may only create sessions if you created the conference.")
 
-        # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
+        return user, conference
+
+
+    def _copyFormToSessionData(self, form, conference):
+        """Validate a SessionForm against its conference and return
+        the dict of Session properties (without the key).
+        """
+        if not form.name:
+            raise endpoints.BadRequestException("Session 'name' field required")
+
+        # copy SessionForm/ProtoRPC Message into dict
+        data = {field.name: getattr(form, field.name) for field in SessionForm.all_fields()}
 
         # add default values for those missing (both data model & outbound Message)
         for df in SESSION_DEFAULTS:
             if data[df] in (None, []):
                 data[df] = SESSION_DEFAULTS[df]
-                setattr(request, df, SESSION_DEFAULTS[df])
+                setattr(form, df, SESSION_DEFAULTS[df])
 
         # convert dates from strings to Date objects
         if data['localDate']:
-            data['localDate'] = datetime.strptime(data['localDate'][:10], "%Y-%m-%d").date()
+            try:
+                data['localDate'] = datetime.strptime(data['localDate'][:10], "%Y-%m-%d").date()
+            except ValueError:
+                raise endpoints.BadRequestException("Session 'localDate': expected YYYY-MM-DD.")
             if conference.startDate and \
                data['localDate'] < conference.startDate:
                     raise endpoints.BadRequestException("Session 'localDate': not within conference dates.")
@@ -313,10 +558,12 @@ class ConferenceApi(remote.Service):
                     raise endpoints.BadRequestException("Session 'localDate': not within conference dates.")
 
         # convert times from strings to Time objects
-        if data['duration']:
-            data['duration'] = datetime.strptime(data['duration'][:5], "%H:%M").time()
-        if data['localTime']:
-            data['localTime'] = datetime.strptime(data['localTime'][:5], "%H:%M").time()
+        for field in ('duration', 'localTime'):
+            if data[field]:
+                try:
+                    data[field] = datetime.strptime(data[field][:5], "%H:%M").time()
+                except ValueError:
+                    raise endpoints.BadRequestException("Session '%s': expected HH:MM." % field)
 
         # convert the session type from enum to string
         if data['typeOfSession']:
@@ -324,62 +571,127 @@ class ConferenceApi(remote.Service):
         else:
             data['typeOfSession'] = 'NOT_SPECIFIED'
 
+        # tokenize name & highlights so getSessionsByTopic() can use
+        # an indexed equality query
+        data['keywords'] = getKeywords(data['name'], *data['highlights'])
+
+        # toss the websafe keys; the key is set by the caller
+        del data['conferenceWebsafeKey']
+        del data['websafeKey']
+        return data
+
+
+    def _queueFeaturedSpeakerTask(self, conference_key, speakerWebsafeKeys):
+        """Check for a featured speaker in a task, so the number of
+        speakers doesn't add to the latency of the request.
+        """
+        if speakerWebsafeKeys:
+            taskqueue.add(params={'websafeConferenceKey': conference_key.urlsafe(),
+                'websafeSpeakerKey': speakerWebsafeKeys},
+                url='/tasks/set_featured_speaker'
+            )
+
+
+    def _createSessionObject(self, request):
+        """Create or update Session object, returning SessionForm/request."""
+        user, conference = self._getConferenceForSessions(request.websafeConferenceKey)
+        data = self._copyFormToSessionData(request, conference)
+
         # Now create the session key.
         # We want an ancestor relationship with the conference. This
         # will give us strong consistency and make for efficient
         # querying of sessions by conference.
         # In order to establish an ancestor relationship we need to:
-        # 1) get the key for the conference
-        conference_key = conference.key
+        # 1) get the key the sessions of the conference are children of
+        #    (None when they are root entities)
+        parent_key = self._getSessionParentKey(conference)
         # 2) create an id for the session
-        # NOTE: allocate_ids returns a list, so take the first element.
-        session_id = Session.allocate_ids(size=1, parent=conference_key)[0]
+        session_id = allocateId(Session, parent=parent_key)
         # 3) create the session key
-        session_key = ndb.Key(Session, session_id, parent=conference_key)
+        session_key = ndb.Key(Session, session_id, parent=parent_key)
         # 4) and then we'll save the key away
         data['key'] = session_key
+        if conference.rootSessions:
+            data['conferenceKey'] = conference.key
 
-        # toss the websafe key
-        del data['conferenceWebsafeKey']
+        # create Session, send email to organizer confirming
+        # creation of Session & return websafe conference key
+        # NOTE: the email task is enqueued while the put is in flight;
+        # the featured speaker task has to wait for the put, as it
+        # queries the sessions of the conference.
+        put_future = Session(**data).put_async()
+        email_rpc = taskqueue.Queue().add_async(taskqueue.Task(
+            params={'email': user.email(),
+                    'sessionInfo': repr(request)},
+            url='/tasks/send_session_confirmation_email'
+        ))
+        put_future.get_result()
+        email_rpc.get_result()
 
-        # get rid of the websafeConferenceKey that was passed in
-        del data['websafeConferenceKey']
+        self._rememberRecentSessions(conference, [session_key])
+        self._queueFeaturedSpeakerTask(conference.key, data['speakerWebsafeKeys'])
 
-        # delete the websafe key. We already have the id.
-        del data['websafeKey']
+        return request
 
-        # create Session, send email to organizer confirming
-        # creation of Session & return websafe conference key
-        Session(**data).put()
 
+    def _createSessionObjects(self, request):
+        """Create a batch of Session objects, returning SessionForms."""
+        user, conference = self._getConferenceForSessions(request.websafeConferenceKey)
+        if not request.items:
+            raise endpoints.BadRequestException("Sessions 'items' field required")
+        if len(request.items) > MAX_SESSIONS_BATCH_SIZE:
+            raise endpoints.BadRequestException(
+                "At most %d sessions may be created at once." % MAX_SESSIONS_BATCH_SIZE)
+
+        # validate every row before writing anything, so a bad row
+        # doesn't leave half an agenda behind
+        rows = []
+        for i, form in enumerate(request.items):
+            try:
+                rows.append(self._copyFormToSessionData(form, conference))
+            except endpoints.BadRequestException as e:
+                raise endpoints.BadRequestException('Session %d: %s' % (i, e))
+
+        # reserve all the ids in one go; allocate_ids returns the
+        # first and last id of the range
+        parent_key = self._getSessionParentKey(conference)
+        first_id, last_id = Session.allocate_ids(size=len(rows), parent=parent_key)
+        sessions = []
+        for session_id, data in zip(range(first_id, last_id + 1), rows):
+            data['key'] = ndb.Key(Session, session_id, parent=parent_key)
+            if conference.rootSessions:
+                data['conferenceKey'] = conference.key
+            sessions.append(Session(**data))
+
+        for i in range(0, len(sessions), SESSIONS_PUT_CHUNK_SIZE):
+            ndb.put_multi(sessions[i:i + SESSIONS_PUT_CHUNK_SIZE])
+        self._rememberRecentSessions(conference, [session.key for session in sessions])
+
+        # one confirmation email & one featured speaker check for the batch
         taskqueue.add(params={'email': user.email(),
-            'sessionInfo': repr(request)},
+            # NOTE: names only, full reprs could overflow the task size limit
+            'sessionInfo': '\r\n'.join(session.name for session in sessions)},
             url='/tasks/send_session_confirmation_email'
         )
+        speaker_wsks = []
+        for session in sessions:
+            for speaker_wsk in session.speakerWebsafeKeys:
+                if speaker_wsk not in speaker_wsks:
+                    speaker_wsks.append(speaker_wsk)
+        self._queueFeaturedSpeakerTask(conference.key, speaker_wsks)
 
-        # If there is more than one session by this speaker at this
-        # conference, also add a new Memcache entry that features the
-        # speaker and session names.
-        # NOTE: we allow for multiple speakers, but this reports only
-        # the first one.
-        print data['speakerWebsafeKeys']
-        for speaker_wsk in data['speakerWebsafeKeys']:
-            sessions = Session.query(ancestor=conference_key).filter(Session.speakerWebsafeKeys==speaker_wsk).fetch()
-            if sessions and len(sessions) > 1:
-                speaker = ndb.Key(urlsafe=speaker_wsk).get()
-                self.cacheFeaturedSpeaker(speaker, sessions)
-                break
-
-        return request
+        return SessionForms(
+            items=[self._copySessionToForm(session) for session in sessions]
+        )
 
 
-    @endpoints.method(SESSION_POST_REQUEST, WebsafeConferenceKeyMessage,
-                      path='conference/{websafeConferenceKey}/session/create',
-                      http_method='POST',
-                      name='createSession')
+    @_instrumentedMethod(SESSION_POST_REQUEST, WebsafeConferenceKeyMessage,
+                         path='conference/{websafeConferenceKey}/session/create',
+                         http_method='POST',
+                         name='createSession')
     def createSession(self, request):
         """Create new session."""
-        conference = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conference = self._getConference(request.websafeConferenceKey)
         if not conference:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
@@ -389,27 +701,42 @@ class ConferenceApi(remote.Service):
         return result
 
 
-    @endpoints.method(WEBSAFE_CONFERENCE_KEY_GET_REQUEST, SessionForms,
+    @_instrumentedMethod(SESSIONS_BATCH_POST_REQUEST, SessionForms,
+                         path='conference/{websafeConferenceKey}/session/batch',
+                         http_method='POST',
+                         name='createSessionsBatch')
+    def createSessionsBatch(self, request):
+        """Create many sessions for a conference at once."""
+        return self._createSessionObjects(request)
+
+
+    @_instrumentedMethod(WEBSAFE_CONFERENCE_KEY_GET_REQUEST, SessionForms,
         path='conference/{websafeConferenceKey}/session',
         http_method='GET', name='getConferenceSessions')
     def getConferenceSessions(self, request):
         """Return all the sessions for a conference."""
 
         # Make sure the conference exists
-        conference = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conference = self._getConference(request.websafeConferenceKey)
         if not conference:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
 
-        # create ancestor query for all key matches for this conference
-        sessions = Session.query(ancestor=conference.key)
+        # query for all the sessions of this conference
+        sessions, next_page_token = self._fetchPage(
+            self._conferenceSessionsQuery(conference), request)
+        # add the recent sessions only once paging is over, so they are
+        # not repeated on a later page once the query sees them
+        if not next_page_token:
+            sessions = self._mergeRecentSessions(conference, sessions)
 
         # return set of ConferenceForm objects per Conference
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
+            items=[self._copySessionToForm(session) for session in sessions],
+            nextPageToken=next_page_token
         )
 
-    @endpoints.method(CONFERENCE_SESSIONS_BY_TYPE_GET_REQUEST, SessionForms,
+    @_instrumentedMethod(CONFERENCE_SESSIONS_BY_TYPE_GET_REQUEST, SessionForms,
             path='conference/{websafeConferenceKey}/session/type/{typeOfSession}',
             http_method='POST',
             name='getConferenceSessionsByType')
@@ -417,102 +744,308 @@ class ConferenceApi(remote.Service):
         """Return all the sessions for a conference."""
 
         # Make sure the conference exists
-        conference = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conference = self._getConference(request.websafeConferenceKey)
         if not conference:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
 
-        # create ancestor query for all key matches for this conference
-        sessions = Session.query(ancestor=conference.key).filter(Session.typeOfSession==request.typeOfSession)
+        # query for all the sessions of this type at this conference
+        sessions, next_page_token = self._fetchPage(
+            self._conferenceSessionsQuery(conference) \
+                .filter(Session.typeOfSession==request.typeOfSession),
+            request)
+        if not next_page_token:
+            sessions = self._mergeRecentSessions(
+                conference, sessions,
+                lambda session: session.typeOfSession == request.typeOfSession)
 
         # return set of ConferenceForm objects per Conference
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
+            items=[self._copySessionToForm(session) for session in sessions],
+            nextPageToken=next_page_token
         )
 
 
-    @endpoints.method(SESSION_TOPIC_GET_REQUEST, SessionForms,
+    @_instrumentedMethod(SESSION_TOPIC_GET_REQUEST, SessionForms,
             path='session/topic',
             http_method='GET',
             name='getSessionsByTopic')
     def getSessionsByTopic(self, request):
         """Return sesssions where the title or the highlights
-        contain the given topic keyword.
+        contain the given topic keyword(s).
         """
-
-        lowerTopic = request.topic.lower()
-        sessions = []
-        for session in Session.query():
-            if lowerTopic in session.name.lower():
-                sessions.append(session)
-            elif session.highlights:
-                for highlight in session.highlights:
-                    if lowerTopic in highlight.lower():
-                        sessions.append(session)
-                        break
+        # NOTE: every word in the topic has to match a keyword. Multiple
+        # equality filters on the same repeated property are served by
+        # a merge join of the built-in index, so no composite index is
+        # needed. We only fetch keys and then batch get the sessions.
+        keywords = getKeywords(request.topic)
+        if not keywords:
+            raise endpoints.BadRequestException("Session 'topic' field required")
+
+        q = Session.query()
+        for keyword in keywords:
+            q = q.filter(Session.keywords == keyword)
+        session_keys, next_page_token = self._fetchPage(q, request, keys_only=True)
+        sessions = ndb.get_multi(session_keys)
 
         # return set of ConferenceForm objects per Conference
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
+            items=[self._copySessionToForm(session) for session in sessions if session],
+            nextPageToken=next_page_token
         )
 
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    def _formatSessionFilters(self, filters):
+        """Parse, check validity and format user supplied session filters.
+        Returns (inequality field, filters).
+        """
+        formatted_filters = []
+        inequality_field = None
+        # session types still allowed by the '=' & '!=' type filters
+        session_types = set(SessionType.names())
+
+        for f in filters:
+            filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
+
+            try:
+                filtr["field"] = SESSION_FIELDS[filtr["field"]]
+                filtr["operator"] = OPERATORS[filtr["operator"]]
+                filtr["value"] = SESSION_FIELD_PARSERS[filtr["field"]](filtr["value"])
+            except (KeyError, TypeError, ValueError, AttributeError):
+                raise endpoints.BadRequestException("Filter contains invalid field, operator or value.")
+
+            # the type of session is always rewritten into an equality
+            # filter below, so it never takes up the inequality
+            if filtr["field"] == "typeOfSession":
+                if filtr["operator"] == "=":
+                    session_types &= set([filtr["value"]])
+                elif filtr["operator"] == "!=":
+                    session_types.discard(filtr["value"])
+                else:
+                    raise endpoints.BadRequestException(
+                        "Session type filters must use 'EQ' or 'NE'.")
+                continue
+
+            # Every operation except "=" is an inequality
+            if filtr["operator"] != "=":
+                if filtr["field"] == "speakerWebsafeKeys":
+                    raise endpoints.BadRequestException(
+                        "Speaker filters must use 'EQ'.")
+                if inequality_field and inequality_field != filtr["field"]:
+                    raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
+                inequality_field = filtr["field"]
+
+            formatted_filters.append(filtr)
+
+        # "not a workshop" becomes "one of the other types", which each
+        # run as an equality query the datastore can serve from an index
+        if len(session_types) < len(SessionType.names()):
+            values = sorted(session_types)
+            # sessions saved without a type count as NOT_SPECIFIED
+            if 'NOT_SPECIFIED' in session_types:
+                values.append(None)
+            formatted_filters.append({"field": "typeOfSession",
+                                      "operator": "in" if len(values) != 1 else "=",
+                                      "value": values if len(values) != 1 else values[0]})
+
+        return (inequality_field, formatted_filters)
+
+
+    def _getSessionQuery(self, filters):
+        """Return formatted session query from the submitted filters."""
+        q = Session.query()
+        inequality_field, filters = self._formatSessionFilters(filters)
+
+        # ndb runs IN as one query per value and can only merge them
+        # (and hand out cursors) when ordered by key last
+        if inequality_field:
+            q = q.order(Session._properties[inequality_field])
+        q = q.order(Session.key)
+
+        # filter through the model properties, so dates and times are
+        # converted to the datetimes the datastore stores
+        for filtr in filters:
+            prop = Session._properties[filtr["field"]]
+            if filtr["operator"] == "in":
+                q = q.filter(prop.IN(filtr["value"]))
+            else:
+                q = q.filter(OPERATOR_FUNCS[filtr["operator"]](prop, filtr["value"]))
+        return q
+
+
+    @_instrumentedMethod(SessionQueryForms, SessionForms,
+            path='querySessions',
+            http_method='POST',
+            name='querySessions')
+    def querySessions(self, request):
+        """Query for sessions."""
+        sessions, next_page_token = self._fetchPage(
+            self._getSessionQuery(request.filters), request)
+
+        return SessionForms(
+            items=[self._copySessionToForm(session) for session in sessions],
+            nextPageToken=next_page_token
+        )
+
+
+    @_instrumentedMethod(message_types.VoidMessage, SessionForms,
             path='session/getNonWorkshopsBefore7',
             http_method='POST',
             name='getNonWorkshopsBefore7')
     def getNonWorkshopsBefore7(self, request):
-        """Return sesssions where the title or the highlights
-        contain the given topic keyword.
-        """
-        # NOTE: we want "localTime < 7pm and session is not a workshop",
-        # however, we can only have one inequality per query, so we
-        # query on time first (so that we can sort on it), and then
-        # filter the workshop sessions out with an in-memory loop.
-        # ALSO NOTE that we allow None session types and times through.
-        sevenPM = time(19)
-        sessions = Session.query(not Session.localTime or Session.localTime <= sevenPM) \
-                          .order(Session.localTime)
-
-        result = []
-        for session in sessions:
-            # skip workshop sessions
-            if session.typeOfSession and session.typeOfSession == 'WORKSHOP':
-                continue
-            result.append(session)
+        """Return sessions that are not workshops and start by 7pm."""
+        # NOTE: "not a workshop" is an inequality too, but
+        # _getSessionQuery() turns it into an IN query over the other
+        # session types, so only the time needs an inequality filter.
+        sessions = self._getSessionQuery([
+            SessionQueryForm(field='TYPE_OF_SESSION', operator='NE', value='WORKSHOP'),
+            SessionQueryForm(field='START_TIME', operator='LTEQ', value='19:00'),
+        ])
 
         # return set of ConferenceForm objects per Conference
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in result]
+            items=[self._copySessionToForm(session) for session in sessions]
         )
 
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
+    def _copyConferenceToForm(self, conf, displayName, seatsAvailable=None):
         """Copy relevant fields from Conference to ConferenceForm."""
         cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
+        # convert Date to date string (see CONFERENCE_FORM_MAPPER);
+        # just copy others
+        for name, getter in CONFERENCE_FORM_MAPPER:
+            setattr(cf, name, getter(conf))
         if displayName:
             setattr(cf, 'organizerDisplayName', displayName)
+        # the seat shards are authoritative over Conference.seatsAvailable
+        if seatsAvailable is not None:
+            setattr(cf, 'seatsAvailable', seatsAvailable)
         cf.check_initialized()
         return cf
 
 
+    def _getOrganizerDisplayNames(self, conferences):
+        """Return a dict of organizerUserId -> displayName for the
+        organizers of the given conferences.
+        """
+        # several conferences usually share an organizer, so only
+        # get each organizer's Profile once, in a single batch
+        user_ids = set(conf.organizerUserId for conf in conferences
+                       if conf and conf.organizerUserId)
+        profiles = ndb.get_multi([ndb.Key(Profile, user_id) for user_id in user_ids])
+
+        # put display names in a dict for easier fetching
+        return dict((profile.key.id(), profile.displayName)
+                    for profile in profiles if profile)
+
+
+    @staticmethod
+    @ndb.tasklet
+    def _getConferenceAsync(conf_key):
+        """Return a future for the conference with the given key (None
+        if it doesn't exist), following a legacy key to the moved
+        conference.
+        """
+        conf = yield conf_key.get_async()
+        if not conf and conf_key.parent():
+            moved_key = yield ConferenceApi._getMovedConferenceKeyAsync(conf_key)
+            if moved_key:
+                conf = yield moved_key.get_async()
+        raise ndb.Return(conf)
+
+
+    @staticmethod
+    @ndb.non_transactional
+    def _getMovedConferenceKeyAsync(legacy_key):
+        """Return a future for the key of the conference that moved to
+        the root from legacy_key (None if it hasn't). The query is only
+        eventually consistent, so a conference may look missing for a
+        moment right after it moved.
+        """
+        return Conference.query(Conference.legacyKey == legacy_key).get_async(keys_only=True)
+
+
+    @staticmethod
+    def _getConference(websafeConferenceKey):
+        """Return the conference with the given websafe key or None."""
+        return ConferenceApi._getConferenceAsync(
+            ndb.Key(urlsafe=websafeConferenceKey)).get_result()
+
+
+    @staticmethod
+    def _getSessionParentKey(conference):
+        """Return the key the sessions of a conference are children of
+        (None for root sessions).
+        """
+        if conference.rootSessions:
+            return None
+        return conference.legacyKey or conference.key
+
+
+    @staticmethod
+    def _conferenceSessionsQuery(conference):
+        """Return a query for the sessions of a conference. It is only
+        eventually consistent for root sessions; see
+        _mergeRecentSessions().
+        """
+        if conference.rootSessions:
+            return Session.query(Session.conferenceKey == conference.key)
+        return Session.query(ancestor=ConferenceApi._getSessionParentKey(conference))
+
+
+    @staticmethod
+    def _rememberRecentSessions(conference, session_keys):
+        """Keep the keys of root sessions just written to a conference
+        in memcache, until the index is sure to have caught up.
+        """
+        if not conference.rootSessions:
+            return
+        client = memcache.Client()
+        key = MEMCACHE_RECENT_SESSIONS_KEY_TPL % conference.key.urlsafe()
+        websafe_keys = [session_key.urlsafe() for session_key in session_keys]
+        for i in range(RECENT_SESSIONS_CAS_RETRIES):
+            recent = client.gets(key)
+            if recent is None:
+                if client.add(key, websafe_keys, time=RECENT_SESSIONS_TIMEOUT):
+                    return
+            elif client.cas(key, recent + websafe_keys, time=RECENT_SESSIONS_TIMEOUT):
+                return
+        logging.warning('Could not remember the new sessions of %s',
+                        conference.key.urlsafe())
+
+
+    @staticmethod
+    def _mergeRecentSessions(conference, sessions, match=None):
+        """Return sessions plus those written to the conference recently
+        (and passing match, if given) that the query didn't see yet. Only
+        call it for the last page of results.
+        """
+        if not conference.rootSessions:
+            return sessions
+        websafe_keys = memcache.get(MEMCACHE_RECENT_SESSIONS_KEY_TPL % conference.key.urlsafe())
+        if not websafe_keys:
+            return sessions
+
+        seen = set(session.key for session in sessions)
+        missing = [key for key in (ndb.Key(urlsafe=wsk) for wsk in websafe_keys)
+                   if key not in seen]
+        recent = [session for session in ndb.get_multi(missing)
+                  if session and (match is None or match(session))]
+        return sessions + recent
+
+
+    @staticmethod
+    def _getConferenceWebsafeKeys(conference):
+        """Return the websafe keys clients may know a conference by."""
+        return [key.urlsafe() for key in (conference.key, conference.legacyKey) if key]
+
+
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user = self._getUser()
+        user_id = self._getUserId()
 
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
@@ -540,17 +1073,17 @@ class ConferenceApi(remote.Service):
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
-        # generate Profile Key based on user ID and Conference
-        # ID based on Profile key get Conference key from ID
-        p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
-        c_key = ndb.Key(Conference, c_id, parent=p_key)
+        # generate a root Conference key, so the conference doesn't
+        # share an entity group with its organizer's other conferences
+        c_key = ndb.Key(Conference, allocateId(Conference))
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
+        data['rootSessions'] = ROOT_SESSIONS
 
-        # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
+        # create Conference with its seat shards, send email to organizer
+        # confirming creation of Conference & return (modified) ConferenceForm
+        ndb.put_multi([Conference(**data)] +
+                      self._newSeatShards(c_key, data['seatsAvailable']))
         taskqueue.add(params={'email': user.email(),
             'conferenceInfo': repr(request)},
             url='/tasks/send_confirmation_email'
@@ -558,18 +1091,83 @@ class ConferenceApi(remote.Service):
         return request
 
 
-    @ndb.transactional()
+# - - - Conference cache - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _getCachedConferenceForm(websafeConferenceKey):
+        """Return the cached ConferenceForm for the conference or None,
+        counting cache hits & misses (flushed to memcache every minute or
+        so, see incrCounter()).
+        """
+        data = memcache.get(MEMCACHE_CONFERENCE_KEY_TPL % websafeConferenceKey)
+        if data:
+            incrCounter(MEMCACHE_CONFERENCE_HITS_KEY)
+            return protojson.decode_message(ConferenceForm, data)
+        incrCounter(MEMCACHE_CONFERENCE_MISSES_KEY)
+        return None
+
+
+    @staticmethod
+    def _cacheConferenceForm(websafeConferenceKey, cf):
+        """Put a ConferenceForm in memcache unless the entry is locked."""
+        # NOTE: add() fails if the key holds anything, including the
+        # lock left behind by _invalidateConferenceCache()
+        memcache.add(MEMCACHE_CONFERENCE_KEY_TPL % websafeConferenceKey,
+                     protojson.encode_message(cf),
+                     time=CONFERENCE_CACHE_TIMEOUT)
+
+
+    @staticmethod
+    def _invalidateConferenceCache(websafeConferenceKey):
+        """Drop the cached ConferenceForm once the current transaction
+        (if any) has committed.
+        """
+        def invalidate():
+            memcache.set(MEMCACHE_CONFERENCE_KEY_TPL % websafeConferenceKey,
+                         CONFERENCE_CACHE_LOCK,
+                         time=CONFERENCE_CACHE_LOCK_TIMEOUT)
+        ndb.get_context().call_on_commit(invalidate)
+
+
+    @staticmethod
+    def _invalidateOrganizerConferences(user_id):
+        """Drop the cached ConferenceForms, and the attendees' schedules,
+        of an organizer's conferences; both hold the organizer's display
+        name.
+        """
+        conferences = Conference.query(Conference.organizerUserId == user_id).fetch()
+        memcache.set_multi({MEMCACHE_CONFERENCE_KEY_TPL % wsck: CONFERENCE_CACHE_LOCK
+                            for conf in conferences
+                            for wsck in ConferenceApi._getConferenceWebsafeKeys(conf)},
+                           time=CONFERENCE_CACHE_LOCK_TIMEOUT)
+        tasks = [taskqueue.Task(params={'websafeConferenceKey': conf.key.urlsafe()},
+                                url='/tasks/invalidate_schedules')
+                 for conf in conferences]
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            taskqueue.Queue().add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+
+    @staticmethod
+    def _conferenceCacheStats():
+        """Return the conference cache hit & miss counters."""
+        stats = memcache.get_multi([MEMCACHE_CONFERENCE_HITS_KEY,
+                                    MEMCACHE_CONFERENCE_MISSES_KEY])
+        return {
+            'hits': stats.get(MEMCACHE_CONFERENCE_HITS_KEY, 0),
+            'misses': stats.get(MEMCACHE_CONFERENCE_MISSES_KEY, 0),
+        }
+
+
+    @ndb.transactional(xg=True)
     def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user = self._getUser()
+        user_id = self._getUserId()
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
 
         # update existing conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = self._getConference(request.websafeConferenceKey)
         # check that conference exists
         if not conf:
             raise endpoints.NotFoundException(
@@ -580,9 +1178,18 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        # the seat shards hold the seats available, so a change of
+        # capacity goes there; seatsAvailable itself isn't writable
+        shards = []
+        if request.maxAttendees is not None and request.maxAttendees != conf.maxAttendees:
+            shards = self._resizeSeatShards(conf, request.maxAttendees)
+            conf.maxAttendees = request.maxAttendees
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
+            if field.name in ('maxAttendees', 'seatsAvailable'):
+                continue
             data = getattr(request, field.name)
             # only copy fields where we get data
             if data not in (None, []):
@@ -593,85 +1200,239 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
-        conf.put()
+        ndb.put_multi([conf] + shards)
+        for wsck in self._getConferenceWebsafeKeys(conf):
+            self._invalidateConferenceCache(wsck)
+        # attendees' schedules hold a copy of the conference; the task
+        # only runs if this transaction commits
+        taskqueue.add(params={'websafeConferenceKey': conf.key.urlsafe()},
+            url='/tasks/invalidate_schedules',
+            transactional=True
+        )
         prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        if shards:
+            seats = sum(shard.seatsAvailable for shard in shards)
+        else:
+            seats = self._getSeatsAvailable([conf])[conf.key]
+        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'), seats)
 
 
-    @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
+    @_instrumentedMethod(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
 
 
-    @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
+    @_instrumentedMethod(CONF_POST_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='PUT', name='updateConference')
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        cf = self._updateConferenceObject(request)
+        # keep the name & city of a nearly sold out conference current
+        self._flagNearlySoldOut(ndb.Key(urlsafe=cf.websafeKey),
+                                cf.name, cf.city, cf.seatsAvailable)
+        return cf
 
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    @_instrumentedMethod(CONF_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
+        # try the cache first
+        cf = self._getCachedConferenceForm(request.websafeConferenceKey)
+        if cf:
+            return cf
+
+        # get ConferenceForm from request; bail if not found
+        cf = self._getConferenceFormAsync(
+            ndb.Key(urlsafe=request.websafeConferenceKey)).get_result()
+        if not cf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
-        # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        # cache & return ConferenceForm
+        self._cacheConferenceForm(request.websafeConferenceKey, cf)
+        return cf
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @ndb.tasklet
+    def _getConferenceFormAsync(self, conf_key):
+        """Return a future for the ConferenceForm of a conference (None
+        if it doesn't exist).
+        """
+        # the seat shard keys follow from the conference key, so get
+        # them while we get the conference
+        shard_futures = ndb.get_multi_async(self._getSeatShardKeys(conf_key))
+        conf = yield self._getConferenceAsync(conf_key)
+        if not conf:
+            raise ndb.Return(None)
+        # a legacy key led us to a moved conference; its shards moved too
+        if conf.key != conf_key:
+            shard_futures = ndb.get_multi_async(self._getSeatShardKeys(conf.key))
+        prof_future = ndb.Key(Profile, conf.organizerUserId).get_async()
+        shards = yield shard_futures
+        prof = yield prof_future
+        raise ndb.Return(self._copyConferenceToForm(
+            conf, getattr(prof, 'displayName', None),
+            self._sumSeatShards(conf, shards)))
+
+
+    @_instrumentedMethod(PAGE_GET_REQUEST, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user = self._getUser()
+        user_id = self._getUserId()
 
-        # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
+        # query on the organizer; conferences aren't in the organizer's
+        # entity group, so a brand new one may take a moment to show up
+        confs, next_page_token = self._fetchPage(
+            Conference.query(Conference.organizerUserId == user_id), request)
         prof = ndb.Key(Profile, user_id).get()
+        seats = self._getSeatsAvailable(confs)
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName'),
+                                              seats[conf.key]) for conf in confs],
+            nextPageToken=next_page_token
         )
 
 
     def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
+        """Return (query, post filters) for the submitted filters and
+        ordering. The datastore gets the equality filters and the
+        inequality filters on one field; the inequality filters on any
+        other fields are returned by field, to be applied after fetching.
+        """
+        inequality_fields, filters = self._formatFilters(request.filters)
 
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
+        inequality_field = None
+        if len(inequality_fields) > 1:
+            inequality_field = self._planInequalityField(
+                request, inequality_fields, filters)
+        elif inequality_fields:
+            inequality_field = inequality_fields[0]
+
+        datastore_filters = []
+        post_filters = collections.OrderedDict()
+        for filtr in filters:
+            if filtr["operator"] == "=" or filtr["field"] == inequality_field:
+                datastore_filters.append(filtr)
+            else:
+                post_filters.setdefault(filtr["field"], []).append(filtr)
+
+        orders = self._formatOrders(request, inequality_field, filters)
+        return self._buildQuery(datastore_filters, orders), post_filters
+
+
+    @staticmethod
+    def _buildQuery(filters, orders):
+        """Return a Conference query with the given filters and orders."""
+        q = Conference.query()
+        for field, direction in orders:
+            prop = Conference.key if field == '__key__' else ndb.GenericProperty(field)
+            q = q.order(-prop if direction == 'desc' else prop)
 
         for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
             formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
             q = q.filter(formatted_query)
         return q
 
 
+    def _planInequalityField(self, request, inequality_fields, filters):
+        """Pick the inequality field for the datastore to filter on: the
+        one that lets the fewest conferences through. Raises if even then
+        we'd expect to scan too many conferences to fill a page.
+        """
+        # the datastore has to sort on the inequality field first
+        order_field = ORDER_FIELDS.get(request.orderBy)
+        candidates = inequality_fields
+        if order_field in inequality_fields:
+            candidates = [order_field]
+
+        # count the conferences passing the equality filters, and those
+        # also passing each field's inequality filters, all in parallel
+        equality_filters = [f for f in filters if f["operator"] == "="]
+        total_future = self._buildQuery(equality_filters, [('name', 'asc')]) \
+            .count_async(limit=QUERY_ESTIMATE_LIMIT)
+        count_futures = {}
+        for field in inequality_fields:
+            field_filters = [f for f in filters if f["field"] == field]
+            count_futures[field] = self._buildQuery(
+                equality_filters + field_filters, [(field, 'asc'), ('name', 'asc')]) \
+                .count_async(limit=QUERY_ESTIMATE_LIMIT)
+        total = total_future.get_result()
+        counts = {field: future.get_result() for field, future in count_futures.items()}
+
+        # ndb runs '!=' as two queries, which it can't page through, so
+        # only push one down if we have to
+        def cost(field):
+            has_ne = any(f["field"] == field and f["operator"] == "!=" for f in filters)
+            return (has_ne, counts[field])
+        inequality_field = min(candidates, key=cost)
+
+        # assuming the fields are independent, estimate how many of the
+        # conferences the datastore returns match everything, and so how
+        # many we'd scan per page. Counts stop at QUERY_ESTIMATE_LIMIT,
+        # so this can only underestimate.
+        if total:
+            matches = float(total)
+            for field in inequality_fields:
+                matches *= counts[field] / float(total)
+            scanned = counts[inequality_field]
+            page_size = request.limit or request.pageSize or DEFAULT_PAGE_SIZE
+            if matches > page_size:
+                scanned = page_size * scanned / matches
+            if scanned > MAX_QUERY_SCAN:
+                raise endpoints.BadRequestException(
+                    "Query is too broad, please narrow the filters.")
+        return inequality_field
+
+
+    @staticmethod
+    def _matchesFilters(conf, field, filters):
+        """Return whether the conference passes all filters on field. As
+        in the datastore, a single value of a repeated field must pass
+        them all.
+        """
+        values = getattr(conf, field)
+        if not isinstance(values, list):
+            values = [values]
+        return any(all(OPERATOR_FUNCS[f["operator"]](value, f["value"]) for f in filters)
+                   for value in values)
+
+
+    def _scanConferences(self, query, post_filters, count, cursor=None):
+        """Stream query results through the post filters until count
+        conferences match or MAX_QUERY_SCAN have been looked at. Returns
+        (conferences, cursor to carry on from or None).
+        """
+        it = query.iter(start_cursor=cursor, batch_size=QUERY_SCAN_BATCH_SIZE,
+                        produce_cursors=True)
+        conferences = []
+        scanned = 0
+        for conf in it:
+            scanned += 1
+            if all(self._matchesFilters(conf, field, filters)
+                   for field, filters in post_filters.iteritems()):
+                conferences.append(conf)
+            if len(conferences) >= count or scanned >= MAX_QUERY_SCAN:
+                if it.has_next():
+                    return conferences, it.cursor_after()
+                break
+        return conferences, None
+
+
     def _formatFilters(self, filters):
-        """Parse, check validity and format user supplied filters."""
+        """Parse, check validity and format user supplied filters.
+        Returns (fields with inequality filters, filters).
+        """
         formatted_filters = []
-        inequality_field = None
+        inequality_fields = []
 
         for f in filters:
             filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
@@ -682,58 +1443,280 @@ class ConferenceApi(remote.Service):
             except KeyError:
                 raise endpoints.BadRequestException("Filter contains invalid field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
+            if filtr["field"] in ["month", "maxAttendees"]:
+                filtr["value"] = int(filtr["value"])
+
+            # Every operation except "=" is an inequality; track the
+            # fields inequalities are performed on
+            if filtr["operator"] != "=" and filtr["field"] not in inequality_fields:
+                inequality_fields.append(filtr["field"])
 
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        return (inequality_fields, formatted_filters)
+
+
+    @staticmethod
+    def _formatOrders(request, inequality_field, filters, check_index=True):
+        """Return the (field, direction) sort orders for the query, checking
+        that index.yaml has an index for any ordering the user asked for.
+        """
+        direction = 'desc' if request.descending else 'asc'
+
+        # If exists, sort on inequality filter first
+        fields = []
+        if inequality_field:
+            fields.append(inequality_field)
+        if request.orderBy:
+            try:
+                order_field = ORDER_FIELDS[request.orderBy]
+            except KeyError:
+                raise endpoints.BadRequestException("Invalid 'orderBy' field.")
+            if inequality_field and order_field != inequality_field:
+                raise endpoints.BadRequestException(
+                    "Results must be ordered by the inequality filter field first.")
+            fields.append(order_field)
+        # name breaks ties, so pages don't overlap
+        fields.append('name')
+
+        # sorting on a field an equality filter holds constant is a no-op
+        equality_fields = sorted(f["field"] for f in filters if f["operator"] == "=")
+        orders = []
+        for field in fields:
+            if field not in equality_fields and (field, direction) not in orders:
+                orders.append((field, direction))
+
+        # ndb runs '!=' as two queries, and can only merge them (and
+        # hand out cursors) when ordered by key last
+        if any(f["field"] == inequality_field and f["operator"] == "!=" for f in filters):
+            orders.append(('__key__', direction))
+
+        if check_index and (request.orderBy or request.descending) and \
+                not ConferenceApi._hasConferenceIndex(equality_fields, orders):
+            raise endpoints.BadRequestException(
+                "There is no index for this combination of filters and ordering.")
+        return orders
+
+
+    @staticmethod
+    def _hasConferenceIndex(equality_fields, orders):
+        """Return whether an index in index.yaml (or a built-in one) serves
+        a Conference query with these equality filters and sort orders.
+        """
+        # if we couldn't read index.yaml leave it to the datastore
+        if CONFERENCE_INDEXES is None:
+            return True
+        return ConferenceApi._indexesServeShape(CONFERENCE_INDEXES,
+                                                (equality_fields, orders))
+
+
+    @staticmethod
+    def _indexesServeShape(indexes, shape):
+        """Return whether indexes serve a query of the given (equality
+        fields, sort orders) shape, either with a single index or by
+        merge joining indexes that share the sort orders.
+        """
+        equality_fields, orders = shape
+        orders = list(orders)
+        # every index ends with an implicit ascending key order
+        if orders and orders[-1] == ('__key__', 'asc'):
+            orders.pop()
+        # built-in single property indexes serve a single sort order
+        if not equality_fields and len(orders) <= 1:
+            return True
+
+        joined = set()
+        for index in indexes:
+            num_equality = len(index) - len(orders)
+            if num_equality < 0 or index[num_equality:] != orders:
+                continue
+            prefix = [name for name, _ in index[:num_equality]]
+            if sorted(prefix) == sorted(equality_fields):
+                return True
+            if prefix and set(prefix) <= set(equality_fields):
+                joined.update(prefix)
+        return bool(equality_fields) and joined == set(equality_fields)
 
 
-    @endpoints.method(ConferenceQueryForms, ConferenceForms,
+    @_instrumentedMethod(ConferenceQueryForms, ConferenceForms,
             path='queryConferences',
             http_method='POST',
             name='queryConferences')
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
+        query, post_filters = self._getQuery(request)
+
+        # with a limit the datastore returns just the top results
+        if request.limit is not None:
+            if not 0 < request.limit <= MAX_PAGE_SIZE:
+                raise endpoints.BadRequestException(
+                    "'limit' must be between 1 and %d." % MAX_PAGE_SIZE)
+            if post_filters:
+                conferences, _ = self._scanConferences(query, post_filters, request.limit)
+            else:
+                conferences = query.fetch(request.limit)
+            next_page_token = None
+        elif post_filters:
+            # a page may come back short if the scan ran out first
+            page_size, cursor = self._getPageParams(request)
+            conferences, next_cursor = self._scanConferences(
+                query, post_filters, page_size, cursor)
+            next_page_token = next_cursor.urlsafe() if next_cursor else None
+        else:
+            conferences, next_page_token = self._fetchPage(query, request)
 
         # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        names = self._getOrganizerDisplayNames(conferences)
+        seats = self._getSeatsAvailable(conferences)
 
         # return individual ConferenceForm object per Conference
         return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
+                items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId),
+                                                  seats[conf.key]) for conf in \
+                conferences],
+                nextPageToken=next_page_token
         )
 
 
+# - - - Index audit - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _conferenceQueryShapes():
+        """Return the (equality fields, sort orders) of every datastore
+        query queryConferences() can run, as _getQuery() builds them.
+        """
+        fields = sorted(FIELDS.values())
+        shapes = set()
+        for num_equality in range(len(fields) + 1):
+            for equality_fields in itertools.combinations(fields, num_equality):
+                filters = [{"field": field, "operator": "="} for field in equality_fields]
+                for inequality_field in [None] + [f for f in fields if f not in equality_fields]:
+                    for orderBy in [None] + sorted(ORDER_FIELDS):
+                        for descending in (False, True):
+                            order_field = ORDER_FIELDS.get(orderBy)
+                            if inequality_field and order_field and \
+                                    order_field != inequality_field:
+                                continue
+                            try:
+                                orders = ConferenceApi._formatOrders(
+                                    ConferenceQueryForms(orderBy=orderBy, descending=descending),
+                                    inequality_field, filters, check_index=False)
+                            except endpoints.BadRequestException:
+                                continue
+                            shapes.add((tuple(sorted(equality_fields)), tuple(orders)))
+        return shapes
+
+
+    @staticmethod
+    def _minimalConferenceIndexes(shapes):
+        """Return the smallest index set we know of that serves shapes:
+        one index per equality field and set of sort orders, which the
+        datastore merge joins when a query has several equality filters.
+        """
+        indexes = set()
+        for equality_fields, orders in shapes:
+            if not equality_fields:
+                if len(orders) > 1:
+                    indexes.add(orders)
+                continue
+            for field in equality_fields:
+                indexes.add(((field, 'asc'),) + orders)
+        return sorted(list(index) for index in indexes)
+
+
+    @staticmethod
+    def _indexRows(entity, index):
+        """Return the number of rows entity has in index; a repeated
+        property multiplies them.
+        """
+        rows = 1
+        for name, _ in index:
+            value = getattr(entity, name, None)
+            rows *= len(value) if isinstance(value, list) else 1
+        return rows
+
+
+    @staticmethod
+    def _builtInIndexRows(entity, names=None):
+        """Return the number of rows entity has in the built-in
+        (ascending & descending) single property indexes.
+        """
+        rows = 0
+        for name, prop in entity._properties.items():
+            if prop._indexed and (names is None or name in names):
+                value = prop._get_value(entity)
+                rows += 2 * (len(value) if isinstance(value, list) else 1)
+        return rows
+
+
+    @staticmethod
+    def _auditConferenceIndexes():
+        """Compare the Conference indexes in index.yaml with the queries
+        queryConferences() can run, and estimate the index rows written
+        per Conference from a sample of them.
+        """
+        if CONFERENCE_INDEXES is None:
+            return {'error': 'Cannot read %s' % INDEX_YAML}
+
+        def describe(index):
+            return ', '.join(name if direction == 'asc' else '%s %s' % (name, direction)
+                             for name, direction in index)
+
+        shapes = ConferenceApi._conferenceQueryShapes()
+        minimal = ConferenceApi._minimalConferenceIndexes(shapes)
+        # the shapes the built-in indexes can't serve
+        composite_shapes = [shape for shape in shapes if shape[0] or len(shape[1]) > 1]
+        # an index.yaml index that serves no query by itself and isn't
+        # one we'd merge join with can be pruned
+        used = [index for index in CONFERENCE_INDEXES if index in minimal or
+                any(ConferenceApi._indexesServeShape([index], shape)
+                    for shape in composite_shapes)]
+        missing = [shape for shape in composite_shapes
+                   if not ConferenceApi._indexesServeShape(CONFERENCE_INDEXES, shape)]
+
+        conferences = Conference.query().fetch(INDEX_AUDIT_SAMPLE_SIZE)
+        def averageRows(indexes):
+            if not conferences:
+                return 0
+            return sum(ConferenceApi._indexRows(conf, index)
+                       for conf in conferences for index in indexes) / float(len(conferences))
+        def averageBuiltInRows(names=None):
+            if not conferences:
+                return 0
+            return sum(ConferenceApi._builtInIndexRows(conf, names)
+                       for conf in conferences) / float(len(conferences))
+
+        # changing a value deletes its old index rows and writes new ones
+        seat_indexes = [index for index in CONFERENCE_INDEXES
+                        if 'seatsAvailable' in [name for name, _ in index]]
+        return {
+            'queryShapes': len(shapes),
+            'indexYaml': len(CONFERENCE_INDEXES),
+            'exactIndexes': len(composite_shapes),
+            'minimalIndexes': [describe(index) for index in minimal],
+            'unusedIndexes': [describe(index) for index in CONFERENCE_INDEXES if index not in used],
+            'unservedQueries': sorted('%s / %s' % (', '.join(equality_fields) or '-',
+                                                   describe(orders))
+                                      for equality_fields, orders in missing),
+            'sampledConferences': len(conferences),
+            'rowsPerConference': {
+                'builtIn': averageBuiltInRows(),
+                'indexYaml': averageRows(CONFERENCE_INDEXES),
+                'minimal': averageRows(minimal),
+            },
+            'rowsPerSeatChange': 2 * (averageBuiltInRows(['seatsAvailable']) +
+                                      averageRows(seat_indexes)),
+        }
+
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
         # copy relevant fields from Profile to ProfileForm
         pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
+        # convert t-shirt string to Enum; keys to websafe keys (see
+        # PROFILE_FORM_MAPPER); just copy others
+        for name, getter in PROFILE_FORM_MAPPER:
+            setattr(pf, name, getter(prof))
         pf.check_initialized()
         return pf
 
@@ -741,13 +1724,16 @@ class ConferenceApi(remote.Service):
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        user = self._getUser()
+
+        # reuse the Profile we already have for this request, except in
+        # a transaction, which has to read its own copy
+        in_transaction = ndb.in_transaction()
+        if self._profile and not in_transaction:
+            return self._profile
 
         # get Profile from datastore
-        user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
+        p_key = ndb.Key(Profile, self._getUserId())
         profile = p_key.get()
         # create new Profile if not there
         if not profile:
@@ -758,7 +1744,13 @@ class ConferenceApi(remote.Service):
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
             profile.put()
+        else:
+            # upgrade websafe key strings in memory; they are saved
+            # with the next put()
+            profile.migrateLegacyKeys()
 
+        if not in_transaction:
+            self._profile = profile
         return profile      # return Profile
 
 
@@ -768,6 +1760,7 @@ class ConferenceApi(remote.Service):
         prof = self._getProfileFromUser()
 
         # if saveProfile(), process user-modifyable fields
+        display_name = prof.displayName
         if save_request:
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
@@ -779,25 +1772,28 @@ class ConferenceApi(remote.Service):
                         #else:
                         #    setattr(prof, field, val)
                         prof.put()
+            # cached forms & schedules of the user's conferences show the old name
+            if prof.displayName != display_name:
+                self._invalidateOrganizerConferences(self._getUserId())
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
 
 
-    @endpoints.method(message_types.VoidMessage, ProfileForm,
+    @_instrumentedMethod(message_types.VoidMessage, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
 
 
-    @endpoints.method(ProfileMiniForm, ProfileForm,
+    @_instrumentedMethod(ProfileMiniForm, ProfileForm,
             path='profile', http_method='POST', name='saveProfile')
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
 
-    @endpoints.method(WISHLIST_POST_REQUEST, ProfileForm,
+    @_instrumentedMethod(WISHLIST_POST_REQUEST, ProfileForm,
             path='profile/wishlist',
             http_method='POST',
             name='addSessionToWishlist')
@@ -806,9 +1802,7 @@ class ConferenceApi(remote.Service):
         updated profile.
         """
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        user = self._getUser()
 
         # Make sure the session exists
         session_key = ndb.Key(urlsafe=request.websafeSessionKey)
@@ -820,16 +1814,16 @@ class ConferenceApi(remote.Service):
         # make sure the session isn't already in the wishlist
         session_id = session.key.id()
         profile = self._getProfileFromUser()
-        if session_key.urlsafe() in profile.wishlistSessionKeys:
+        if session_key in profile.wishlistSessionKeys:
             raise endpoints.BadRequestException("Session already in wishlist.")
 
-        profile.wishlistSessionKeys.append(session_key.urlsafe())
+        profile.wishlistSessionKeys.append(session_key)
         profile.put()
 
         # return the updated profile
         return self._copyProfileToForm(profile)
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @_instrumentedMethod(message_types.VoidMessage, SessionForms,
             path='profile/wishlist',
             http_method='GET',
             name='getSessionsInWishlist')
@@ -837,167 +1831,674 @@ class ConferenceApi(remote.Service):
         """Return the sessions in the user's wishlist.
         """
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        user = self._getUser()
 
-        # get the user's profile
+        # get the user's profile and all the sessions in one batch
         profile = self._getProfileFromUser()
-        sessionForms = []
-        for websafe_key in profile.wishlistSessionKeys:
-            key = ndb.Key(urlsafe=websafe_key)
-            session = key.get()
-            if session:
-                sessionForms.append(self._copySessionToForm(session))
+        sessions = ndb.get_multi(profile.wishlistSessionKeys)
+
+        # sessions that have since been deleted are pruned from the
+        # wishlist by a task so we don't hold up the response
+        missing = [key.urlsafe() for key, session
+                   in zip(profile.wishlistSessionKeys, sessions) if not session]
+        if missing:
+            taskqueue.add(params={'userId': profile.key.id(),
+                'websafeSessionKey': missing},
+                url='/tasks/prune_wishlist'
+            )
+
+        # order by date & time, sessions without either go first
+        sessions = sorted((session for session in sessions if session),
+                          key=lambda session: (session.localDate or date.min,
+                                               session.localTime or time.min))
 
         # return set of ConferenceForm objects per Conference
-        return SessionForms(items=sessionForms)
+        return SessionForms(
+            items=[self._copySessionToForm(session) for session in sessions]
+        )
+
+
+    @staticmethod
+    @ndb.transactional()
+    def _pruneWishlist(user_id, websafeSessionKeys):
+        """Remove the given (deleted) sessions from a user's wishlist;
+        used by the prune wishlist task.
+        """
+        profile = ndb.Key(Profile, user_id).get()
+        if not profile:
+            return
+        changed = profile.migrateLegacyKeys()
+        deleted = set(ndb.Key(urlsafe=websafe_key) for websafe_key in websafeSessionKeys)
+        wishlist = [key for key in profile.wishlistSessionKeys if key not in deleted]
+        if len(wishlist) != len(profile.wishlistSessionKeys):
+            profile.wishlistSessionKeys = wishlist
+            changed = True
+        if changed:
+            profile.put()
+
+
+    @staticmethod
+    @ndb.transactional()
+    def _migrateProfileKeys(profile_key):
+        """Save a profile with its legacy websafe key strings moved over
+        to the key lists, and the keys of conferences that have moved
+        out of their organizer's entity group updated; used by the
+        migrate profile keys task.
+        """
+        profile = profile_key.get()
+        if not profile:
+            return
+        changed = profile.migrateLegacyKeys()
+
+        moved = ConferenceApi._getMovedConferenceKeys(profile.conferenceKeysToAttend)
+        if moved:
+            profile.conferenceKeysToAttend = [moved.get(key, key)
+                                              for key in profile.conferenceKeysToAttend]
+            # the schedule holds the old websafe keys
+            ConferenceApi._getScheduleKey(profile_key).delete()
+            changed = True
+
+        if changed:
+            profile.put()
+
+
+    @staticmethod
+    @ndb.non_transactional
+    def _getMovedConferenceKeys(conf_keys):
+        """Return a dict of legacy key -> key for those of the given
+        conference keys whose conferences have moved to the root.
+        """
+        futures = dict((key, ConferenceApi._getMovedConferenceKeyAsync(key))
+                       for key in conf_keys if key.parent())
+        moved = dict((key, future.get_result()) for key, future in futures.items())
+        return dict((key, moved_key) for key, moved_key in moved.items() if moved_key)
 
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
-    def _cacheAnnouncement():
+    def _isNearlySoldOut(seats):
+        """Return True if a conference with this many seats left
+        belongs in the announcement.
+        """
+        return 0 < seats <= NEARLY_SOLD_OUT_SEATS
+
+
+    @staticmethod
+    @ndb.non_transactional
+    def _flagNearlySoldOut(conf_key, name, city, seats):
+        """Add the conference to (or drop it from) the nearly sold out
+        conferences, resetting the announcements if that changed them.
+        """
+        flag_key = ndb.Key(NearlySoldOut, conf_key.urlsafe())
+        flag = flag_key.get()
+        if ConferenceApi._isNearlySoldOut(seats):
+            if flag and flag.name == name and flag.city == city:
+                return
+            NearlySoldOut(key=flag_key, name=name, city=city).put()
+        elif flag:
+            flag_key.delete()
+        else:
+            return
+
+        # the announcements are rebuilt on their next read
+        cities = set([city, flag and flag.city])
+        memcache.delete_multi([MEMCACHE_ANNOUNCEMENTS_KEY] +
+                              [MEMCACHE_ANNOUNCEMENTS_CITY_KEY_TPL % c for c in cities if c])
+
+
+    @staticmethod
+    def _cacheAnnouncement(city=None):
         """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        memcache cron job & getAnnouncement().
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
+        # NearlySoldOut is maintained as seats are taken & given back,
+        # so this is a small query instead of a range scan over the
+        # seatsAvailable index of every conference
+        q = NearlySoldOut.query()
+        if city:
+            q = q.filter(NearlySoldOut.city == city)
+            key = MEMCACHE_ANNOUNCEMENTS_CITY_KEY_TPL % city
+        else:
+            key = MEMCACHE_ANNOUNCEMENTS_KEY
+        names = sorted(flag.name for flag in q)
 
-        if confs:
+        if names:
             # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+            # format announcement
+            announcement = ANNOUNCEMENT_TPL % ', '.join(names)
         else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
             announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+        # NOTE: an empty announcement is cached too, so misses don't
+        # keep querying; the timeout bounds how stale it can get
+        memcache.set(key, announcement, time=ANNOUNCEMENT_TIMEOUT)
 
         return announcement
 
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @_instrumentedMethod(ANNOUNCEMENT_GET_REQUEST, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
-        """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
-
+        """Return Announcement (optionally for one city) from memcache."""
+        if request.city:
+            key = MEMCACHE_ANNOUNCEMENTS_CITY_KEY_TPL % request.city
+        else:
+            key = MEMCACHE_ANNOUNCEMENTS_KEY
+        announcement = memcache.get(key)
+        if announcement is None:
+            announcement = self._cacheAnnouncement(request.city)
+        return StringMessage(data=announcement)
 
 
 # - - - Featured Speaker - - - - - - - - - - - - - - - - - - - -
 
-    def cacheFeaturedSpeaker(self, speaker, sessions):
-        """Create announcement about a featured speaker & assign to
-        memcache; used by memcache cron job &
-        setFeaturedSpeakerHandler().
+    @staticmethod
+    def _featuredSpeakerTimeout(conference):
+        """Return the memcache expiration for a conference's featured
+        speaker: the end of the conference, or a little while for
+        conferences that are over or have no end date.
         """
-        if speaker:
-            conference = sessions[0].key.parent().get()
+        if conference.endDate:
+            end = datetime.combine(conference.endDate + timedelta(days=1), time())
+            if end > datetime.now():
+                # NOTE: an absolute Unix time, as the relative form is
+                # limited to one month
+                return calendar.timegm(end.timetuple())
+        return FEATURED_SPEAKER_TIMEOUT
+
 
+    @staticmethod
+    def _setFeaturedSpeaker(conference, speaker_wsk):
+        """Create announcement about the featured speaker of a conference
+        & assign to memcache, returning it. An empty announcement is
+        cached too, meaning the conference has no featured speaker.
+        """
+        text = ""
+        speaker = ndb.Key(urlsafe=speaker_wsk).get() if speaker_wsk else None
+        if speaker:
             text = '{S} is speaking a bunch at the {C} conference!' \
                    .format(S=speaker.displayName, C=conference.name)
+            sessions = ConferenceApi._conferenceSessionsQuery(conference) \
+                              .filter(Session.speakerWebsafeKeys == speaker_wsk) \
+                              .fetch(projection=[Session.name])
+            sessions = ConferenceApi._mergeRecentSessions(
+                conference, sessions,
+                lambda session: speaker_wsk in session.speakerWebsafeKeys)
             for session in sessions:
                 text += ' {S}!'.format(S=session.name)
-            memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY, text)
-        else:
-            # NOTE: we're never clearing the cache. Should probably
-            # do that after the conference is over...chron job...?
-            text = ""
-            memcache.delete(MEMCACHE_FEATURED_SPEAKER_KEY)
 
+        memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY_TPL % conference.key.urlsafe(),
+                     text, time=ConferenceApi._featuredSpeakerTimeout(conference))
         return text
 
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @staticmethod
+    def _cacheFeaturedSpeaker(websafeConferenceKey, websafeSpeakerKeys):
+        """Feature the first of the given speakers with more than one
+        session at the conference; used by the set featured speaker task.
+        """
+        conference = ConferenceApi._getConference(websafeConferenceKey)
+        if not conference:
+            return ""
+        for speaker_wsk in websafeSpeakerKeys:
+            q = ConferenceApi._conferenceSessionsQuery(conference) \
+                             .filter(Session.speakerWebsafeKeys == speaker_wsk)
+            # a keys only count is enough to decide, unless the query
+            # may not see the session that was just added
+            count = q.count(limit=2)
+            if count < 2 and conference.rootSessions:
+                count = len(ConferenceApi._mergeRecentSessions(
+                    conference, q.fetch(2),
+                    lambda session: speaker_wsk in session.speakerWebsafeKeys))
+            if count < 2:
+                continue
+
+            text = ConferenceApi._setFeaturedSpeaker(conference, speaker_wsk)
+            # also keep the most recent one for getFeaturedSpeaker()
+            memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY, text,
+                         time=ConferenceApi._featuredSpeakerTimeout(conference))
+            return text
+
+        return ""
+
+
+    @staticmethod
+    def _getFeaturedSpeaker(websafeConferenceKey):
+        """Return the featured speaker announcement of a conference from
+        memcache, working it out from the datastore if it isn't there.
+        """
+        text = memcache.get(MEMCACHE_FEATURED_SPEAKER_KEY_TPL % websafeConferenceKey)
+        if text is not None:
+            return text
+
+        conference = ConferenceApi._getConference(websafeConferenceKey)
+        if not conference:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % websafeConferenceKey)
+
+        # feature the speaker with the most sessions, if that is more
+        # than one. The projection gives us one result per speaker of
+        # each session.
+        sessions = ConferenceApi._conferenceSessionsQuery(conference) \
+                          .fetch(projection=[Session.speakerWebsafeKeys])
+        sessions = ConferenceApi._mergeRecentSessions(conference, sessions)
+        counts = collections.Counter()
+        for session in sessions:
+            counts.update(session.speakerWebsafeKeys)
+        speaker_wsk = None
+        if counts:
+            speaker_wsk, count = counts.most_common(1)[0]
+            if count < 2:
+                speaker_wsk = None
+
+        return ConferenceApi._setFeaturedSpeaker(conference, speaker_wsk)
+
+
+    @_instrumentedMethod(message_types.VoidMessage, StringMessage,
         path='conference/featuredspeaker/get',
         http_method='GET', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
-        """Return Featured Speaker from memcache."""
+        """Return the most recent Featured Speaker from memcache."""
         return StringMessage(data=memcache.get(MEMCACHE_FEATURED_SPEAKER_KEY) or "")
 
 
+    @_instrumentedMethod(CONF_GET_REQUEST, StringMessage,
+        path='conference/{websafeConferenceKey}/featuredspeaker',
+        http_method='GET', name='getConferenceFeaturedSpeaker')
+    def getConferenceFeaturedSpeaker(self, request):
+        """Return Featured Speaker of a conference."""
+        return StringMessage(data=self._getFeaturedSpeaker(request.websafeConferenceKey))
+
+
+# - - - Seat shards - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _getSeatShardKeys(conf_key):
+        """Return the keys of the seat shards of a conference."""
+        wsck = conf_key.urlsafe()
+        return [ndb.Key(SeatShard, '%s:%d' % (wsck, i))
+                for i in range(NUM_SEAT_SHARDS)]
+
+
+    @staticmethod
+    def _newSeatShards(conf_key, seats):
+        """Return (unsaved) seat shards splitting seats evenly."""
+        shard_keys = ConferenceApi._getSeatShardKeys(conf_key)
+        per_shard, extra = divmod(max(seats or 0, 0), len(shard_keys))
+        return [SeatShard(key=shard_key,
+                          seatsAvailable=per_shard + (1 if i < extra else 0))
+                for i, shard_key in enumerate(shard_keys)]
+
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _initSeatShards(conf):
+        """Create the seat shards of a conference created before seats
+        were sharded, returning all the shards.
+        """
+        shards = ndb.get_multi(ConferenceApi._getSeatShardKeys(conf.key))
+        if not any(shards):
+            shards = ConferenceApi._newSeatShards(conf.key, conf.seatsAvailable)
+            ndb.put_multi(shards)
+        return shards
+
+
+    @staticmethod
+    def _resizeSeatShards(conf, max_attendees):
+        """Return the (unsaved) seat shards of a conference with the seats
+        available changed to match max_attendees. Raises if that is
+        fewer than the attendees already registered.
+        """
+        shards = ndb.get_multi(ConferenceApi._getSeatShardKeys(conf.key))
+        if not any(shards):
+            shards = ConferenceApi._newSeatShards(conf.key, conf.seatsAvailable)
+        seats = ConferenceApi._sumSeatShards(conf, shards)
+        registered = max((conf.maxAttendees or 0) - seats, 0)
+        if max_attendees < registered:
+            raise endpoints.BadRequestException(
+                "'maxAttendees' can't be less than the %d attendees registered." % registered)
+
+        # the transaction has read every shard, so registrations can't
+        # slip in between; spread the new total evenly over them
+        return ConferenceApi._newSeatShards(conf.key, max_attendees - registered)
+
+
+    @staticmethod
+    @ndb.non_transactional
+    def _getSeatsAvailable(conferences):
+        """Return a dict of conference key -> seats available, summed
+        over the seat shards of each conference.
+        """
+        conferences = [conf for conf in conferences if conf]
+        shard_keys = []
+        for conf in conferences:
+            shard_keys.extend(ConferenceApi._getSeatShardKeys(conf.key))
+        shards = ndb.get_multi(shard_keys)
+
+        seats = {}
+        for i, conf in enumerate(conferences):
+            seats[conf.key] = ConferenceApi._sumSeatShards(
+                conf, shards[i * NUM_SEAT_SHARDS:(i + 1) * NUM_SEAT_SHARDS])
+        return seats
+
+
+    @staticmethod
+    def _sumSeatShards(conf, shards):
+        """Return the seats available of a conference given its shards."""
+        if any(shards):
+            return sum(shard.seatsAvailable for shard in shards if shard)
+        # no shards yet; the Conference still holds the count
+        return conf.seatsAvailable
+
+
+    @staticmethod
+    def _reconcileSeats():
+        """Check the nearly sold out flag of conferences with recently
+        changed seat shards; used by the reconcile seats cron job.
+        """
+        since = datetime.now() - timedelta(seconds=SEAT_RECONCILE_WINDOW)
+        shard_keys = SeatShard.query(SeatShard.updated >= since) \
+                              .fetch(keys_only=True)
+
+        # shard ids are "<websafe conference key>:<shard number>"
+        conf_keys = set(ndb.Key(urlsafe=shard_key.id().rsplit(':', 1)[0])
+                        for shard_key in shard_keys)
+        conferences = [conf for conf in ndb.get_multi(list(conf_keys)) if conf]
+        # registrations flag conferences from a possibly stale snapshot;
+        # this fixes up any they got wrong
+        ConferenceApi._checkNearlySoldOut(conferences)
+        return len(conferences)
+
+
+    @staticmethod
+    def _checkNearlySoldOut(conferences):
+        """Flag or unflag each conference as nearly sold out from the
+        seats its shards hold.
+        """
+        # NOTE: the count isn't written back to the Conference; nothing
+        # queries on it, and the shards are what we serve
+        seats = ConferenceApi._getSeatsAvailable(conferences)
+        for conf in conferences:
+            ConferenceApi._flagNearlySoldOut(conf.key, conf.name, conf.city,
+                                             seats[conf.key])
+
+# - - - Moving conferences - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _copyConferenceToRoot(legacy_key):
+        """Re-create a conference that is a child of its organizer's
+        Profile as a root entity, moving its seat shards along. Returns
+        the moved conference, or None if there was nothing to move.
+        """
+        # NOTE: 2 conferences + 2 x NUM_SEAT_SHARDS shards stays under
+        # the 25 entity groups an XG transaction may touch
+        conf = legacy_key.get()
+        if not conf:
+            return None
+        # ids were allocated per organizer, so the conference gets a new
+        # one from the range new conferences are created in
+        root_key = ndb.Key(Conference, allocateId(Conference))
+
+        data = conf.to_dict()
+        data['legacyKey'] = legacy_key
+        moved = Conference(key=root_key, **data)
+
+        old_shard_keys = ConferenceApi._getSeatShardKeys(legacy_key)
+        shards = [SeatShard(key=shard_key, seatsAvailable=shard.seatsAvailable)
+                  for shard_key, shard in zip(ConferenceApi._getSeatShardKeys(root_key),
+                                              ndb.get_multi(old_shard_keys))
+                  if shard]
+
+        ndb.put_multi([moved] + shards)
+        ndb.delete_multi([legacy_key] + old_shard_keys)
+        ConferenceApi._invalidateConferenceCache(legacy_key.urlsafe())
+        return moved
+
+
+    @staticmethod
+    def _moveConference(legacy_key):
+        """Move a conference out of its organizer's entity group; used
+        by the move conferences task. Attendees' profiles keep the
+        legacy key until the migrate profile keys task updates them.
+        """
+        moved = ConferenceApi._copyConferenceToRoot(legacy_key)
+        if not moved:
+            return
+        # the nearly sold out flag is keyed by the websafe key too
+        ConferenceApi._flagNearlySoldOut(legacy_key, moved.name, moved.city, 0)
+        seats = ConferenceApi._getSeatsAvailable([moved])
+        ConferenceApi._flagNearlySoldOut(moved.key, moved.name, moved.city,
+                                         seats[moved.key])
+
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
     @ndb.transactional(xg=True)
-    def _conferenceRegistration(self, request, reg=True):
-        """Register or unregister user for selected conference."""
+    def _seatShardRegistration(self, conf, shard_key, reg=True, cf=None):
+        """Register or unregister user, taking the seat from or giving
+        it back to the given seat shard, and keep the user's schedule
+        (if any) in step. Returns None if the shard has run out of seats.
+        """
         retval = None
         prof = self._getProfileFromUser() # get user Profile
-
-        # check if conf exists given websafeConfKey
-        # get conference; check that it exists
-        wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % wsck)
+        shard, schedule = ndb.get_multi([shard_key, self._getScheduleKey(prof.key)])
+        # the profile may still hold the legacy key of a moved conference
+        wscks = self._getConferenceWebsafeKeys(conf)
+        registered = [key for key in prof.conferenceKeysToAttend
+                      if key in (conf.key, conf.legacyKey)]
 
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if registered:
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException(
-                    "There are no seats available.")
+            # check if seats avail; another shard may still have some
+            if shard.seatsAvailable <= 0:
+                return None
 
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
+            prof.conferenceKeysToAttend.append(conf.key)
+            shard.seatsAvailable -= 1
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if registered:
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
+                for key in registered:
+                    prof.conferenceKeysToAttend.remove(key)
+                shard.seatsAvailable += 1
                 retval = True
             else:
-                retval = False
+                return False
+
+        # the schedule is in the Profile's entity group, so updating it
+        # doesn't add to the transaction
+        entities = [prof, shard]
+        if schedule:
+            cfs = protojson.decode_message(ConferenceForms, schedule.conferences)
+            if reg:
+                cfs.items.append(cf)
+            else:
+                cfs.items = [item for item in cfs.items if item.websafeKey not in wscks]
+            schedule.conferences = self._encodeSchedule(cfs)
+            entities.append(schedule)
 
         # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+        ndb.put_multi(entities)
+        for wsck in wscks:
+            self._invalidateConferenceCache(wsck)
+        # the Profile we cached for this request is stale now
+        ndb.get_context().call_on_commit(lambda: setattr(self, '_profile', prof))
+        return retval
+
+
+    def _conferenceRegistration(self, request, reg=True):
+        """Register or unregister user for selected conference."""
+        # check if conf exists given websafeConfKey
+        # get conference; check that it exists
+        wsck = request.websafeConferenceKey
+        conf = self._getConference(wsck)
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+
+        shards = ndb.get_multi(self._getSeatShardKeys(conf.key))
+        if not any(shards):
+            shards = self._initSeatShards(conf)
+        shards = [shard for shard in shards if shard]
+        seats = self._sumSeatShards(conf, shards)
+
+        # unregister, giving the seat back to any shard
+        if not reg:
+            shard_key = random.choice(shards).key
+            retval = self._seatShardRegistration(conf, shard_key, reg=False)
+            if retval:
+                self._seatsChanged(conf, seats, seats + 1)
+            return BooleanMessage(data=retval)
+
+        # the form that goes into the user's schedule
+        organizer = ndb.Key(Profile, conf.organizerUserId).get()
+        cf = self._copyConferenceToForm(conf, getattr(organizer, 'displayName', None),
+                                        max(seats - 1, 0))
+
+        # register: each shard is its own entity group, so spreading
+        # registrants over the shards with seats left keeps them from
+        # contending. A shard never goes below zero, so even if our
+        # snapshot is stale we can't oversell.
+        shard_keys = [shard.key for shard in shards if shard.seatsAvailable > 0]
+        random.shuffle(shard_keys)
+        for shard_key in shard_keys:
+            if self._seatShardRegistration(conf, shard_key, cf=cf):
+                self._seatsChanged(conf, seats, seats - 1)
+                return BooleanMessage(data=True)
+        raise ConflictException(
+            "There are no seats available.")
+
+
+    def _seatsChanged(self, conf, before, after):
+        """Flag or unflag the conference as nearly sold out if a
+        registration made it cross the threshold.
+        """
+        if self._isNearlySoldOut(before) != self._isNearlySoldOut(after):
+            self._flagNearlySoldOut(conf.key, conf.name, conf.city, after)
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @_instrumentedMethod(message_types.VoidMessage, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
-        prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        # make sure user is authed
+        user = self._getUser()
 
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        # serve the materialized schedule if we have one
+        schedule = self._getScheduleKey(ndb.Key(Profile, self._getUserId())).get()
+        if schedule:
+            cfs = protojson.decode_message(ConferenceForms, schedule.conferences)
+            self._addScheduleSeats(cfs)
+            return cfs
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        prof = self._getProfileFromUser() # get user Profile
+        conf_keys = list(prof.conferenceKeysToAttend)
+
+        # get conferences, organizers & seats all at once; ndb batches
+        # the gets of all these tasklets into a few RPCs
+        futures = [self._getConferenceFormAsync(conf_key) for conf_key in conf_keys]
+        forms = [future.get_result() for future in futures]
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-         for conf in conferences]
-        )
+        cfs = ConferenceForms(items=[cf for cf in forms if cf])
+        self._saveSchedule(prof.key, conf_keys, cfs)
+        return cfs
 
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+# - - - Schedules - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _getScheduleKey(profile_key):
+        """Return the key of the schedule of a user."""
+        return ndb.Key(ConferenceSchedule, SCHEDULE_ID, parent=profile_key)
+
+
+    @staticmethod
+    @ndb.transactional()
+    def _saveSchedule(profile_key, conf_keys, cfs):
+        """Save the schedule built for the given conferences, unless the
+        user has (un)registered since we read the profile.
+        """
+        prof = profile_key.get()
+        if prof and prof.conferenceKeysToAttend == conf_keys:
+            ConferenceSchedule(key=ConferenceApi._getScheduleKey(profile_key),
+                               conferences=ConferenceApi._encodeSchedule(cfs)).put()
+
+
+    @staticmethod
+    def _encodeSchedule(cfs):
+        """Return the ConferenceForms as stored in a schedule: without the
+        seats available, which every registration changes. Those are
+        filled in from the seat shards when it's served.
+        """
+        stored = protojson.decode_message(ConferenceForms, protojson.encode_message(cfs))
+        for cf in stored.items:
+            cf.seatsAvailable = None
+        return protojson.encode_message(stored)
+
+
+    @staticmethod
+    def _addScheduleSeats(cfs):
+        """Fill in the seats available of the ConferenceForms of a
+        schedule from the seat shards of their conferences.
+        """
+        conf_keys = [ndb.Key(urlsafe=cf.websafeKey) for cf in cfs.items]
+        shard_keys = []
+        for conf_key in conf_keys:
+            shard_keys.extend(ConferenceApi._getSeatShardKeys(conf_key))
+        shards = ndb.get_multi(shard_keys)
+
+        # conferences without shards yet still hold the count
+        unsharded = []
+        for i, cf in enumerate(cfs.items):
+            conf_shards = shards[i * NUM_SEAT_SHARDS:(i + 1) * NUM_SEAT_SHARDS]
+            if any(conf_shards):
+                cf.seatsAvailable = sum(shard.seatsAvailable for shard in conf_shards if shard)
+            else:
+                unsharded.append((cf, conf_keys[i]))
+        if unsharded:
+            conferences = ndb.get_multi([conf_key for _, conf_key in unsharded])
+            for (cf, _), conf in zip(unsharded, conferences):
+                cf.seatsAvailable = conf.seatsAvailable if conf else None
+
+
+    @staticmethod
+    def _invalidateSchedules(websafeConferenceKey, cursor=None):
+        """Delete a batch of the schedules of a conference's attendees;
+        used by the invalidate schedules task. Returns the cursor of the
+        next batch or None when done.
+        """
+        # profiles not migrated yet hold the legacy key of a moved
+        # conference; ndb can only page through the IN when ordered by key
+        conf = ConferenceApi._getConference(websafeConferenceKey)
+        conf_keys = [ndb.Key(urlsafe=websafeConferenceKey)]
+        if conf and conf.legacyKey:
+            conf_keys = [conf.key, conf.legacyKey]
+        profile_keys, next_cursor, more = Profile.query(
+            Profile.conferenceKeysToAttend.IN(conf_keys)
+        ).order(Profile.key).fetch_page(
+            SCHEDULE_INVALIDATE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        ndb.delete_multi([ConferenceApi._getScheduleKey(profile_key)
+                          for profile_key in profile_keys])
+        if more and next_cursor:
+            return next_cursor
+        return None
+
+
+    @_instrumentedMethod(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
     def registerForConference(self, request):
@@ -1005,7 +2506,7 @@ class ConferenceApi(remote.Service):
         return self._conferenceRegistration(request)
 
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    @_instrumentedMethod(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='DELETE', name='unregisterFromConference')
     def unregisterFromConference(self, request):
@@ -1013,7 +2514,7 @@ class ConferenceApi(remote.Service):
         return self._conferenceRegistration(request, reg=False)
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @_instrumentedMethod(message_types.VoidMessage, ConferenceForms,
             path='filterPlayground',
             http_method='GET', name='filterPlayground')
     def filterPlayground(self, request):
@@ -12,10 +12,39 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+from models import Conference
+from models import Profile
+from models import Session
+from utils import getKeywords
+from utils import getRpcStats
+
+MIGRATION_BATCH_SIZE = 100
+BACKFILL_NEARLY_SOLD_OUT_TASK = 'backfill-nearly-sold-out'
+
+# migrations an admin starts from /admin/migrations/<name>, by name:
+# (task url, description)
+MIGRATIONS = {
+    'move_conferences': ('/tasks/move_conferences',
+        "Move conferences out of their organizers' entity groups, then "
+        "update their attendees' profiles."),
+    'reindex_session_keywords': ('/tasks/reindex_session_keywords',
+        "Index the keywords of every session, for getSessionsByTopic."),
+}
+MIGRATION_FORM = ('<form method="post"><p>%s</p>'
+                  '<input type="submit" value="Start"></form>')
+
+def getCursor(request):
+    """Return the query Cursor passed to a chained task, if any."""
+    cursor = request.get('cursor')
+    return Cursor(urlsafe=cursor) if cursor else None
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -24,6 +53,30 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
+class ReconcileSeatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Flag conferences that recent registrations nearly sold out."""
+        # the first run also flags the conferences that were nearly sold
+        # out before flags were kept. The task name stops later runs from
+        # repeating that (if one slips through, it's just redundant).
+        try:
+            taskqueue.add(name=BACKFILL_NEARLY_SOLD_OUT_TASK,
+                url='/tasks/backfill_nearly_sold_out'
+            )
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+        ConferenceApi._reconcileSeats()
+        self.response.set_status(204)
+
+
+class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
+    def post(self):
+        """Set Featured Speaker in Memcache."""
+        ConferenceApi._cacheFeaturedSpeaker(
+            self.request.get('websafeConferenceKey'),
+            self.request.get_all('websafeSpeakerKey'))
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
         """Send email confirming Conference creation."""
@@ -66,9 +119,152 @@ class SendSpeakerConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 
+class MigrateProfileKeysHandler(webapp2.RequestHandler):
+    def post(self):
+        """Move Profile websafe key strings over to key properties and
+        point them at moved conferences, one batch at a time.
+        """
+        cursor = getCursor(self.request)
+        profile_keys, next_cursor, more = Profile.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        # one transaction per profile so we can't clobber a
+        # registration that happens while we migrate
+        for profile_key in profile_keys:
+            ConferenceApi._migrateProfileKeys(profile_key)
+        # chain the next batch so we never run into the request deadline
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                url='/tasks/migrate_profile_keys'
+            )
+
+
+class StartMigrationHandler(webapp2.RequestHandler):
+    def get(self, name):
+        """Show the form that starts a migration."""
+        if name not in MIGRATIONS:
+            self.abort(404)
+        self.response.write(MIGRATION_FORM % MIGRATIONS[name][1])
+
+    def post(self, name):
+        """Start a migration by queueing its first batch."""
+        if name not in MIGRATIONS:
+            self.abort(404)
+        taskqueue.add(url=MIGRATIONS[name][0])
+        self.response.set_status(202)
+        self.response.write('Started.')
+
+
+class MoveConferencesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Move conferences out of their organizers' entity groups one
+        batch at a time, then update the profiles of their attendees.
+        """
+        cursor = getCursor(self.request)
+        conf_keys, next_cursor, more = Conference.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        # moved conferences are root entities, so sort before the
+        # cursor and aren't seen again
+        for conf_key in conf_keys:
+            if conf_key.parent():
+                ConferenceApi._moveConference(conf_key)
+        # chain the next batch so we never run into the request deadline
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                url='/tasks/move_conferences'
+            )
+        else:
+            taskqueue.add(url='/tasks/migrate_profile_keys')
+
+
+class BackfillNearlySoldOutHandler(webapp2.RequestHandler):
+    def post(self):
+        """Flag the nearly sold out conferences one batch at a time."""
+        cursor = getCursor(self.request)
+        conferences, next_cursor, more = Conference.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+        ConferenceApi._checkNearlySoldOut(conferences)
+        # chain the next batch so we never run into the request deadline
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                url='/tasks/backfill_nearly_sold_out'
+            )
+
+
+class InvalidateSchedulesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Delete the schedules holding an updated conference."""
+        websafe_conference_key = self.request.get('websafeConferenceKey')
+        next_cursor = ConferenceApi._invalidateSchedules(
+            websafe_conference_key, getCursor(self.request))
+        # chain the next batch so we never run into the request deadline
+        if next_cursor:
+            taskqueue.add(params={'websafeConferenceKey': websafe_conference_key,
+                'cursor': next_cursor.urlsafe()},
+                url='/tasks/invalidate_schedules'
+            )
+
+
+class PruneWishlistHandler(webapp2.RequestHandler):
+    def post(self):
+        """Remove deleted sessions from a user's wishlist."""
+        ConferenceApi._pruneWishlist(
+            self.request.get('userId'),
+            set(self.request.get_all('websafeSessionKey')))
+
+
+class ReindexSessionKeywordsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Backfill Session.keywords one batch at a time."""
+        cursor = getCursor(self.request)
+        sessions, next_cursor, more = Session.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+        for session in sessions:
+            session.keywords = getKeywords(session.name, *session.highlights)
+        ndb.put_multi(sessions)
+        # chain the next batch so we never run into the request deadline
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                url='/tasks/reindex_session_keywords'
+            )
+
+
+class ConferenceCacheStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the getConference() cache hit/miss counters."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(ConferenceApi._conferenceCacheStats()))
+
+
+class ConferenceIndexAuditHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report which Conference indexes queries need & what they cost."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(ConferenceApi._auditConferenceIndexes(),
+                                       indent=2, sort_keys=True))
+
+
+class RpcStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the RPC counts & timings of each API method."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(getRpcStats(), indent=2, sort_keys=True))
+
+
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/reconcile_seats', ReconcileSeatsHandler),
+    ('/admin/conference_cache_stats', ConferenceCacheStatsHandler),
+    ('/admin/conference_index_audit', ConferenceIndexAuditHandler),
+    ('/admin/rpc_stats', RpcStatsHandler),
+    (r'/admin/migrations/(\w+)', StartMigrationHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
+    ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler),
     ('/tasks/send_session_confirmation_email', SendSessionConfirmationEmailHandler),
     ('/tasks/send_speaker_confirmation_email', SendSpeakerConfirmationEmailHandler),
+    ('/tasks/reindex_session_keywords', ReindexSessionKeywordsHandler),
+    ('/tasks/prune_wishlist', PruneWishlistHandler),
+    ('/tasks/invalidate_schedules', InvalidateSchedulesHandler),
+    ('/tasks/migrate_profile_keys', MigrateProfileKeysHandler),
+    ('/tasks/move_conferences', MoveConferencesHandler),
+    ('/tasks/backfill_nearly_sold_out', BackfillNearlySoldOutHandler),
 ], debug=True)
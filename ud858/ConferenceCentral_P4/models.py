@@ -26,8 +26,38 @@ class Profile(ndb.Model):
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
-    conferenceKeysToAttend = ndb.StringProperty(repeated=True)
-    wishlistSessionKeys = ndb.StringProperty(repeated=True)
+    conferenceKeysToAttend = ndb.KeyProperty(kind='Conference', repeated=True,
+                                             name='conferenceKeys')
+    wishlistSessionKeys = ndb.KeyProperty(kind='Session', repeated=True,
+                                          name='wishlistKeys')
+    # websafe key strings stored before the lists above became key
+    # properties; moved over by migrateLegacyKeys()
+    legacyConferenceKeysToAttend = ndb.StringProperty(repeated=True, indexed=False,
+                                                      name='conferenceKeysToAttend')
+    legacyWishlistSessionKeys = ndb.StringProperty(repeated=True, indexed=False,
+                                                   name='wishlistSessionKeys')
+
+    def migrateLegacyKeys(self):
+        """Move legacy websafe key strings over to the key lists.
+        Returns True if the profile changed and needs to be put.
+        """
+        if not (self.legacyConferenceKeysToAttend or self.legacyWishlistSessionKeys):
+            return False
+        for keys, legacy in ((self.conferenceKeysToAttend, self.legacyConferenceKeysToAttend),
+                             (self.wishlistSessionKeys, self.legacyWishlistSessionKeys)):
+            for websafe_key in legacy:
+                key = ndb.Key(urlsafe=websafe_key)
+                if key not in keys:
+                    keys.append(key)
+        self.legacyConferenceKeysToAttend = []
+        self.legacyWishlistSessionKeys = []
+        return True
+
+class ConferenceSchedule(ndb.Model):
+    """ConferenceSchedule -- ready to serve ConferenceForms of the
+    conferences a user attends; child of the user's Profile
+    """
+    conferences = ndb.TextProperty()
 
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
@@ -75,6 +105,7 @@ class SpeakerForm(messages.Message):
 class SpeakerForms(messages.Message):
     """SpeakerForms -- multiple Speaker outbound form message"""
     items = messages.MessageField(SpeakerForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 class Session(ndb.Model):
     """Conference session model"""
@@ -90,6 +121,11 @@ class Session(ndb.Model):
     localDate       = ndb.DateProperty()
     localTime       = ndb.TimeProperty()
     speakerWebsafeKeys = ndb.StringProperty(repeated=True)
+    # lowercased tokens from name & highlights; lets us answer topic
+    # searches with an indexed equality query instead of a full scan.
+    keywords        = ndb.StringProperty(repeated=True)
+    # set on root sessions, which aren't children of their conference
+    conferenceKey   = ndb.KeyProperty(kind='Conference')
 
 class SessionForm(messages.Message):
     """Conference session Form -- Conference session outbound form message"""
@@ -106,11 +142,14 @@ class SessionForm(messages.Message):
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 class Conference(ndb.Model):
     """Conference -- Conference object"""
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
+    # NOTE: conferences are root entities; getConferencesCreated()
+    # queries on the organizer instead of by ancestor
     organizerUserId = ndb.StringProperty()
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
@@ -118,7 +157,26 @@ class Conference(ndb.Model):
     month           = ndb.IntegerProperty() # TODO: do we need for indexing like Java?
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
-    seatsAvailable  = ndb.IntegerProperty()
+    # the seats at creation; once a conference has SeatShards those
+    # hold the count, so registrations never write the Conference
+    seatsAvailable  = ndb.IntegerProperty(indexed=False)
+    # the key the conference had as a child of its organizer's Profile,
+    # for conferences moved out of that entity group (with a new id).
+    # Their sessions stay children of it; legacy keys are looked up
+    # by it.
+    legacyKey       = ndb.KeyProperty(kind='Conference')
+    # whether the sessions are root entities (see settings.ROOT_SESSIONS)
+    rootSessions    = ndb.BooleanProperty(default=False, indexed=False)
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of the available seats of a conference"""
+    seatsAvailable  = ndb.IntegerProperty(default=0, indexed=False)
+    updated         = ndb.DateTimeProperty(auto_now=True)
+
+class NearlySoldOut(ndb.Model):
+    """NearlySoldOut -- flags a conference with only a few seats left"""
+    name            = ndb.StringProperty(indexed=False)
+    city            = ndb.StringProperty()
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -138,6 +196,7 @@ class ConferenceForm(messages.Message):
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -164,6 +223,18 @@ class SessionType(messages.Enum):
     KEYNOTE = 3
     WORKSHOP = 4
 
+class SessionQueryForm(messages.Message):
+    """SessionQueryForm -- Session query inbound form message"""
+    field = messages.StringField(1)
+    operator = messages.StringField(2)
+    value = messages.StringField(3)
+
+class SessionQueryForms(messages.Message):
+    """SessionQueryForms -- multiple SessionQueryForm inbound form message"""
+    filters = messages.MessageField(SessionQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3)
+
 class ConferenceQueryForm(messages.Message):
     """ConferenceQueryForm -- Conference query inbound form message"""
     field = messages.StringField(1)
@@ -173,3 +244,8 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3)
+    orderBy = messages.StringField(4)
+    descending = messages.BooleanField(5)
+    limit = messages.IntegerField(6, variant=messages.Variant.INT32)
@@ -16,3 +16,8 @@ WEB_CLIENT_ID = '142909964784-2duer61on4hlog52g4dtr31rvthca6eq.apps.googleuserco
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Store the sessions of conferences created from now on as root entities
+# that reference their conference, instead of as children of it, so
+# agenda edits don't write to the conference's entity group.
+ROOT_SESSIONS = False
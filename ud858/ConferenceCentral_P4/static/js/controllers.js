@@ -347,12 +347,61 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     $scope.pagination.currentPage = 0;
     $scope.pagination.pageSize = 20;
     /**
-     * Returns the number of the pages in the pagination.
+     * The page tokens returned by the server so far; pageTokens[i] fetches page i.
+     * @type {Array}
+     */
+    $scope.pagination.pageTokens = [null];
+
+    /**
+     * Forgets the page tokens and goes back to the first page.
+     */
+    $scope.pagination.reset = function () {
+        $scope.pagination.currentPage = 0;
+        $scope.pagination.pageTokens = [null];
+    };
+
+    /**
+     * Remembers the token of the page following the current one.
+     *
+     * @param nextPageToken the nextPageToken of the response, if any
+     */
+    $scope.pagination.setNextPageToken = function (nextPageToken) {
+        var pageTokens = $scope.pagination.pageTokens.slice(0, $scope.pagination.currentPage + 1);
+        if (nextPageToken) {
+            pageTokens.push(nextPageToken);
+        }
+        $scope.pagination.pageTokens = pageTokens;
+    };
+
+    /**
+     * Returns the token of the current page.
+     *
+     * @returns {string|null}
+     */
+    $scope.pagination.currentPageToken = function () {
+        return $scope.pagination.pageTokens[$scope.pagination.currentPage];
+    };
+
+    /**
+     * Fetches the given page from the server.
+     *
+     * @param page the page number
+     */
+    $scope.pagination.goToPage = function (page) {
+        if (page < 0 || page >= $scope.pagination.numberOfPages()) {
+            return;
+        }
+        $scope.pagination.currentPage = page;
+        $scope.queryConferencesPage();
+    };
+
+    /**
+     * Returns the number of the pages known so far in the pagination.
      *
      * @returns {number}
      */
     $scope.pagination.numberOfPages = function () {
-        return Math.ceil($scope.conferences.length / $scope.pagination.pageSize);
+        return $scope.pagination.pageTokens.length;
     };
 
     /**
@@ -409,10 +458,19 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     };
 
     /**
-     * Query the conferences depending on the tab currently selected.
+     * Query the first page of conferences depending on the tab currently selected.
      *
      */
     $scope.queryConferences = function () {
+        $scope.pagination.reset();
+        $scope.queryConferencesPage();
+    };
+
+    /**
+     * Query the current page of conferences depending on the tab currently selected.
+     *
+     */
+    $scope.queryConferencesPage = function () {
         $scope.submitted = false;
         if ($scope.selectedTab == 'ALL') {
             $scope.queryConferencesAll();
@@ -428,7 +486,11 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.queryConferencesAll = function () {
         var sendFilters = {
-            filters: []
+            filters: [],
+            pageSize: $scope.pagination.pageSize
+        }
+        if ($scope.pagination.currentPageToken()) {
+            sendFilters.pageToken = $scope.pagination.currentPageToken();
         }
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
@@ -462,6 +524,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
+                        $scope.pagination.setNextPageToken(resp.nextPageToken);
                     }
                     $scope.submitted = true;
                 });
@@ -472,8 +535,14 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      * Invokes the conference.getConferencesCreated method.
      */
     $scope.getConferencesCreated = function () {
+        var params = {
+            pageSize: $scope.pagination.pageSize
+        };
+        if ($scope.pagination.currentPageToken()) {
+            params.pageToken = $scope.pagination.currentPageToken();
+        }
         $scope.loading = true;
-        gapi.client.conference.getConferencesCreated().
+        gapi.client.conference.getConferencesCreated(params).
             execute(function (resp) {
                 $scope.$apply(function () {
                     $scope.loading = false;
@@ -499,6 +568,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
+                        $scope.pagination.setNextPageToken(resp.nextPageToken);
                     }
                     $scope.submitted = true;
                 });
@@ -528,6 +598,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                     } else {
                         // The request has succeeded.
                         $scope.conferences = resp.result.items;
+                        $scope.pagination.setNextPageToken(null);
                         $scope.loading = false;
                         $scope.messages = 'Query succeeded : Conferences you will attend (or you have attended)';
                         $scope.alertStatus = 'success';
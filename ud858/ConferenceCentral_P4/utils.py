@@ -1,11 +1,298 @@
+import bisect
+import collections
+import functools
+import hashlib
 import json
 import os
+import re
+import threading
 import time
 import uuid
 
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
 from models import Profile
 
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+TOKENINFO_ATTEMPTS = 3
+TOKENINFO_DEADLINE = 5
+TOKENINFO_WAIT_TIMEOUT = 30
+TOKENINFO_MAX_TIMEOUT = 60 * 60
+TOKENINFO_BACKOFF = 0.5
+TOKENINFO_MAX_BACKOFF = 1
+MEMCACHE_TOKENINFO_KEY_TPL = 'TOKENINFO:%s'
+
+# lookups in progress on this instance, by token hash
+_tokenInfoLock = threading.Lock()
+_tokenInfoInFlight = {}
+
+ID_BLOCK_SIZE = 100
+# children of the same parent are created far less often
+CHILD_ID_BLOCK_SIZE = 10
+MAX_CHILD_ID_BLOCKS = 100
+
+# ids reserved by this instance, by (kind, parent key)
+_idBlocksLock = threading.Lock()
+_idBlocks = collections.OrderedDict()
+
+MEMCACHE_RPC_STATS_KEY = 'RPC_STATS'
+RPC_STATS_FLUSH_INTERVAL = 60 # seconds
+RPC_STATS_CAS_RETRIES = 10
+# upper bounds (ms) of the wall time histogram buckets; one more
+# bucket counts everything slower
+RPC_STATS_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# the method being recorded on this thread, and the stats this
+# instance hasn't flushed to memcache yet, by method name
+_rpcStatsLocal = threading.local()
+_rpcStatsLock = threading.Lock()
+_rpcStats = {}
+_rpcStatsFlushed = time.time()
+
+COUNTERS_FLUSH_INTERVAL = 60 # seconds
+
+# memcache counter increments this instance hasn't flushed yet
+_countersLock = threading.Lock()
+_counters = collections.Counter()
+_countersFlushed = time.time()
+
+KEYWORD_SPLIT_RE = re.compile(r'\W+', re.UNICODE)
+
+def getKeywords(*texts):
+    """Return the unique, lowercased word tokens found in texts."""
+    keywords = set()
+    for text in texts:
+        if text:
+            keywords.update(KEYWORD_SPLIT_RE.split(text.lower()))
+    keywords.discard('')
+    return sorted(keywords)
+
+@ndb.tasklet
+def _fetchTokenInfoAsync(token, token_type):
+    """Look token up with Google, backing off between retries. The
+    caller waits on the result, so the request thread is held for the
+    whole backoff; keep it short.
+    """
+    ctx = ndb.get_context()
+    wait = TOKENINFO_BACKOFF
+    for i in range(TOKENINFO_ATTEMPTS):
+        try:
+            resp = yield ctx.urlfetch(TOKENINFO_URL % (token_type, token),
+                                      deadline=TOKENINFO_DEADLINE)
+        except urlfetch.Error:
+            resp = None
+        if resp and resp.status_code == 200:
+            raise ndb.Return(json.loads(resp.content))
+        elif resp and resp.status_code == 400 and 'invalid_token' in resp.content:
+            token_type = 'access_token'
+        elif i + 1 < TOKENINFO_ATTEMPTS:
+            yield ndb.sleep(wait)
+            wait = min(wait * 2, TOKENINFO_MAX_BACKOFF)
+    raise ndb.Return({})
+
+def _getTokenInfo(token, token_type):
+    """Return Google's tokeninfo for token, caching it in memcache until
+    the token expires. Concurrent requests on this instance for the same
+    token share a single lookup.
+    """
+    token_hash = hashlib.sha256(token).hexdigest()
+    cache_key = MEMCACHE_TOKENINFO_KEY_TPL % token_hash
+    info = memcache.get(cache_key)
+    if info is not None:
+        return info
+
+    with _tokenInfoLock:
+        pending = _tokenInfoInFlight.get(token_hash)
+        leader = pending is None
+        if leader:
+            pending = _tokenInfoInFlight[token_hash] = {
+                'done': threading.Event(), 'info': {}}
+
+    # someone else is already looking this token up; wait for them
+    if not leader:
+        pending['done'].wait(TOKENINFO_WAIT_TIMEOUT)
+        return pending['info']
+
+    try:
+        info = _fetchTokenInfoAsync(token, token_type).get_result()
+        timeout = min(int(info.get('expires_in', 0)), TOKENINFO_MAX_TIMEOUT)
+        if info.get('user_id') and timeout > 0:
+            memcache.set(cache_key, info, time=timeout)
+        pending['info'] = info
+    finally:
+        with _tokenInfoLock:
+            del _tokenInfoInFlight[token_hash]
+        pending['done'].set()
+    return info
+
+def _takeId(block):
+    """Return the next id of block, or None if it has run dry."""
+    while block['ranges']:
+        next_id, last_id = block['ranges'][0]
+        if next_id <= last_id:
+            block['ranges'][0][0] += 1
+            return next_id
+        block['ranges'].pop(0)
+    return None
+
+def allocateId(model_class, parent=None):
+    """Return a new id for a model_class entity under parent, handing it
+    out from a block of ids reserved by this instance, so only one
+    create in a block's worth makes an allocate_ids round trip.
+    """
+    block_key = (model_class._get_kind(), parent)
+    size = CHILD_ID_BLOCK_SIZE if parent else ID_BLOCK_SIZE
+    with _idBlocksLock:
+        block = _idBlocks.get(block_key)
+        if block is None:
+            block = _idBlocks[block_key] = {'ranges': [], 'lock': threading.Lock()}
+            # forget the blocks of the parents we haven't used for longest
+            child_keys = [k for k in _idBlocks if k[1] is not None]
+            for k in child_keys[:len(child_keys) - MAX_CHILD_ID_BLOCKS]:
+                del _idBlocks[k]
+        else:
+            # keep the most recently used blocks at the end
+            del _idBlocks[block_key]
+            _idBlocks[block_key] = block
+
+    # NOTE: the refill is synchronous on purpose. An ndb future only
+    # completes on the event loop of the request that started it, so a
+    # background refill could be lost with that request. Holding the
+    # block's lock makes the other threads wanting these ids wait for
+    # the one refill instead of each making their own round trip.
+    with block['lock']:
+        new_id = _takeId(block)
+        if new_id is None:
+            block['ranges'].append(list(model_class.allocate_ids(size=size, parent=parent)))
+            new_id = _takeId(block)
+    return new_id
+
+def _newMethodStats():
+    return {
+        'calls': 0,
+        'errors': 0,
+        'wallMs': 0,
+        'wallHistogram': [0] * (len(RPC_STATS_BUCKETS) + 1),
+        'rpcs': {},
+        'rpcMs': {},
+    }
+
+def _mergeRpcStats(into, stats):
+    """Add the per-method stats in stats to those in into."""
+    for name, method_stats in stats.items():
+        total = into.setdefault(name, _newMethodStats())
+        for field in ('calls', 'errors', 'wallMs'):
+            total[field] += method_stats[field]
+        total['wallHistogram'] = [a + b for a, b in zip(
+            total['wallHistogram'], method_stats['wallHistogram'])]
+        for field in ('rpcs', 'rpcMs'):
+            for service, value in method_stats[field].items():
+                total[field][service] = total[field].get(service, 0) + value
+
+def _rpcPreCallHook(service, call, request, response, rpc):
+    current = getattr(_rpcStatsLocal, 'current', None)
+    if current is not None:
+        current['started'][id(rpc)] = time.time()
+
+def _rpcPostCallHook(service, call, request, response, rpc, error):
+    current = getattr(_rpcStatsLocal, 'current', None)
+    if current is None:
+        return
+    current['rpcs'][service] = current['rpcs'].get(service, 0) + 1
+    started = current['started'].pop(id(rpc), None)
+    if started is not None:
+        ms = int((time.time() - started) * 1000)
+        current['rpcMs'][service] = current['rpcMs'].get(service, 0) + ms
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('rpc_stats', _rpcPreCallHook)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('rpc_stats', _rpcPostCallHook)
+
+def _flushRpcStats():
+    """Add this instance's stats to those in memcache, every
+    RPC_STATS_FLUSH_INTERVAL at most.
+    """
+    global _rpcStatsFlushed
+    with _rpcStatsLock:
+        if time.time() - _rpcStatsFlushed < RPC_STATS_FLUSH_INTERVAL:
+            return
+        pending = dict(_rpcStats)
+        _rpcStats.clear()
+        _rpcStatsFlushed = time.time()
+    if not pending:
+        return
+
+    client = memcache.Client()
+    for i in range(RPC_STATS_CAS_RETRIES):
+        stats = client.gets(MEMCACHE_RPC_STATS_KEY)
+        if stats is None:
+            if client.add(MEMCACHE_RPC_STATS_KEY, pending):
+                return
+        else:
+            _mergeRpcStats(stats, pending)
+            if client.cas(MEMCACHE_RPC_STATS_KEY, stats):
+                return
+    # keep them for the next flush
+    with _rpcStatsLock:
+        _mergeRpcStats(_rpcStats, pending)
+
+def recordRpcStats(func):
+    """Decorator counting the RPCs func issues by service, and timing
+    them and func itself. Calls made while another recorded function
+    is running count towards that one.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_rpcStatsLocal, 'current', None) is not None:
+            return func(*args, **kwargs)
+        current = _rpcStatsLocal.current = {'started': {}, 'rpcs': {}, 'rpcMs': {}}
+        started = time.time()
+        failed = True
+        try:
+            result = func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            _rpcStatsLocal.current = None
+            ms = int((time.time() - started) * 1000)
+            method_stats = _newMethodStats()
+            method_stats.update(calls=1, errors=int(failed), wallMs=ms,
+                                rpcs=current['rpcs'], rpcMs=current['rpcMs'])
+            method_stats['wallHistogram'][bisect.bisect_left(RPC_STATS_BUCKETS, ms)] = 1
+            with _rpcStatsLock:
+                _mergeRpcStats(_rpcStats, {func.__name__: method_stats})
+            _flushRpcStats()
+    return wrapper
+
+def incrCounter(key, delta=1):
+    """Add delta to the memcache counter key. Increments are summed per
+    instance and flushed together every COUNTERS_FLUSH_INTERVAL, so a
+    hot counter doesn't cost an RPC per event.
+    """
+    global _countersFlushed
+    with _countersLock:
+        _counters[key] += delta
+        if time.time() - _countersFlushed < COUNTERS_FLUSH_INTERVAL:
+            return
+        pending = dict(_counters)
+        _counters.clear()
+        _countersFlushed = time.time()
+
+    results = memcache.offset_multi(pending, initial_value=0)
+    # keep what didn't make it for the next flush
+    with _countersLock:
+        for key, value in results.items():
+            if value is None:
+                _counters[key] += pending[key]
+
+def getRpcStats():
+    """Return the per-method stats all instances have flushed."""
+    return {
+        'bucketsMs': list(RPC_STATS_BUCKETS),
+        'methods': memcache.get(MEMCACHE_RPC_STATS_KEY) or {},
+    }
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()
@@ -17,22 +304,7 @@ def getUserId(user, id_type="email"):
         token_type = 'id_token'
         if 'OAUTH_USER_ID' in os.environ:
             token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return _getTokenInfo(token, token_type).get('user_id', '')
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm